@@ -0,0 +1,73 @@
+"""Кеш отрендеренных в JSON списков редко меняющихся справочников."""
+import hashlib
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.renderers import JSONRenderer
+
+RenderedList = namedtuple('RenderedList', ('body', 'etag', 'last_modified',
+                                           'built_at'))
+
+
+class RenderedListCache:
+    """Готовые байты JSON-ответов в памяти процесса.
+
+    Записи сбрасываются сигналами при изменении моделей
+    и по истечении RENDERED_LIST_CACHE_TTL секунд.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key, build):
+        ttl = settings.RENDERED_LIST_CACHE_TTL
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (
+                    ttl is not None
+                    and time.monotonic() - entry.built_at > ttl):
+                body = build()
+                entry = RenderedList(
+                    body=body,
+                    etag=f'"{hashlib.sha256(body).hexdigest()}"',
+                    last_modified=int(time.time()),
+                    built_at=time.monotonic(),
+                )
+                self._entries[key] = entry
+            return entry
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+rendered_list_cache = RenderedListCache()
+
+
+class RenderedListMixin:
+    """Отдаёт список объектов viewset из кеша отрендеренного JSON
+    с заголовками ETag и Last-Modified и отвечает 304 на If-None-Match.
+    """
+
+    def get_rendered_list_key(self):
+        return self.get_queryset().model._meta.label_lower
+
+    def render_list(self):
+        serializer = self.get_serializer(self.get_queryset(), many=True)
+        return JSONRenderer().render(serializer.data)
+
+    def rendered_list(self, request):
+        entry = rendered_list_cache.get(self.get_rendered_list_key(),
+                                        self.render_list)
+        response = HttpResponse(entry.body, content_type='application/json')
+        response['ETag'] = entry.etag
+        response['Last-Modified'] = http_date(entry.last_modified)
+        return get_conditional_response(
+            request, etag=entry.etag, last_modified=entry.last_modified,
+            response=response)
@@ -0,0 +1,69 @@
+"""Индекс ингредиентов в памяти процесса для автодополнения по префиксу."""
+import bisect
+import threading
+import time
+
+from django.conf import settings
+
+from recipes.models import Ingredient  # isort: split
+
+
+def normalize(value):
+    """Приводит название к виду для сравнения без учёта регистра и ё/е."""
+    return value.casefold().replace('ё', 'е')
+
+
+class IngredientPrefixIndex:
+    """Отсортированный по нормализованному названию список ингредиентов.
+
+    Поиск по префиксу выполняется бинарным поиском без обращения к БД.
+    Индекс строится лениво при первом запросе и перестраивается после
+    invalidate() или по истечении INGREDIENT_INDEX_TTL секунд.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = None
+        self._rows = None
+        self._built_at = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._keys = None
+            self._rows = None
+
+    def _is_stale(self):
+        ttl = settings.INGREDIENT_INDEX_TTL
+        return (self._keys is None
+                or (ttl is not None
+                    and time.monotonic() - self._built_at > ttl))
+
+    def _build(self):
+        entries = sorted(
+            (normalize(name), pk, name, measurement_unit)
+            for pk, name, measurement_unit in Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit').iterator()
+        )
+        self._keys = [entry[0] for entry in entries]
+        self._rows = [
+            {'id': pk, 'name': name, 'measurement_unit': measurement_unit}
+            for _, pk, name, measurement_unit in entries
+        ]
+        self._built_at = time.monotonic()
+
+    def search(self, prefix):
+        """Ингредиенты, название которых начинается с prefix.
+
+        Точные совпадения идут первыми, остальные по алфавиту.
+        """
+        with self._lock:
+            if self._is_stale():
+                self._build()
+            keys, rows = self._keys, self._rows
+        key = normalize(prefix)
+        start = bisect.bisect_left(keys, key)
+        end = bisect.bisect_left(keys, key + chr(0x10FFFF), lo=start)
+        return rows[start:end]
+
+
+ingredient_index = IngredientPrefixIndex()
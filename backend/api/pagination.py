@@ -1,8 +1,334 @@
-from rest_framework.pagination import PageNumberPagination
+import hashlib
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 from foodgram.settings import REST_FRAMEWORK  # isort: split
 
 
+def get_keyset_ordering(queryset):
+    """Порядок queryset по полям модели, дополненный первичным ключом
+    для однозначного положения курсора.
+
+    Сортировка по аннотациям (например, по релевантности поиска)
+    заменяется порядком из Meta.ordering модели.
+    """
+    field_names = {field.name for field in queryset.model._meta.fields}
+    ordering = tuple(
+        field for field in queryset.query.order_by
+        if isinstance(field, str) and field.lstrip('-') in field_names
+    ) or tuple(queryset.model._meta.ordering)
+    if not any(field.lstrip('-') in ('pk', 'id') for field in ordering):
+        ordering += ('-pk',)
+    return ordering
+
+
+def estimate_count(queryset):
+    """Оценка числа строк таблицы модели по статистике PostgreSQL
+    или None, если оценка недоступна.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+            (queryset.model._meta.db_table,))
+        row = cursor.fetchone()
+    if row is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+def get_count(queryset):
+    """Число объектов queryset без COUNT(*) на каждый запрос.
+
+    Для неотфильтрованной большой таблицы берётся оценка из статистики
+    PostgreSQL, в остальных случаях точное значение кешируется
+    на PAGINATION_COUNT_CACHE_TTL секунд по тексту SQL-запроса.
+    """
+    if queryset.query.is_empty():
+        return 0
+    if not queryset.query.where:
+        estimate = estimate_count(queryset)
+        if (estimate is not None
+                and estimate >= settings.PAGINATION_ESTIMATE_THRESHOLD):
+            return estimate
+    sql = str(queryset.query).encode('utf-8')
+    key = f'pagination-count:{hashlib.md5(sql).hexdigest()}'
+    return cache.get_or_set(key, queryset.count,
+                            settings.PAGINATION_COUNT_CACHE_TTL)
+
+
+class ProbedPage(Page):
+    """Страница, наличие следующей страницы у которой определено
+    выборкой лишней строки, а не общим числом объектов.
+    """
+
+    def __init__(self, object_list, number, paginator, has_more):
+        super().__init__(object_list, number, paginator)
+        self.has_more = has_more
+
+    def has_next(self):
+        return self.has_more
+
+    def end_index(self):
+        return self.start_index() + len(self.object_list) - 1
+
+
+class CachedCountPaginator(Paginator):
+    """Paginator с приблизительным числом объектов (get_count).
+
+    Число используется только для метаданных ответа: страница
+    выбирается по смещению с лишней строкой и не обрезается по count,
+    а count поправляется по тому, что нашлось на странице.
+    """
+
+    @cached_property
+    def count(self):
+        return get_count(self.object_list)
+
+    def validate_number(self, number):
+        try:
+            if isinstance(number, float) and not number.is_integer():
+                raise ValueError
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(_('That page number is not an integer'))
+        if number < 1:
+            raise EmptyPage(_('That page number is less than 1'))
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if not rows and number > 1:
+            raise EmptyPage(_('That page contains no results'))
+        seen = bottom + len(rows)
+        self.__dict__['count'] = (max(self.count, seen + 1) if has_more
+                                  else seen)
+        self.__dict__.pop('num_pages', None)
+        return ProbedPage(rows, number, self, has_more)
+
+
+class ExactCountPaginator(CachedCountPaginator):
+    """CachedCountPaginator с точным COUNT(*) для списков, которые
+    меняются от действий самого пользователя.
+    """
+
+    @cached_property
+    def count(self):
+        return self.object_list.count()
+
+
+def reverse_ordering(ordering):
+    return tuple(field[1:] if field.startswith('-') else f'-{field}'
+                 for field in ordering)
+
+
+class KeysetPagination(CursorPagination):
+    """Пагинация по курсору со значениями всех полей сортировки.
+
+    В отличие от CursorPagination, курсор хранит значения каждого поля
+    ordering, поэтому строки с одинаковым первым полем (pub_date)
+    разделяются по следующим полям, а не смещением.
+    """
+
+    page_size = REST_FRAMEWORK['PAGE_SIZE']
+    page_size_query_param = 'limit'
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = []
+        for field in ordering:
+            field_name = field.lstrip('-')
+            if isinstance(instance, dict):
+                values.append(instance[field_name])
+            else:
+                values.append(getattr(instance, field_name))
+        return json.dumps([str(value) for value in values])
+
+    def get_position_filter(self, position, reverse):
+        """Условие «строка после position» в порядке self.ordering
+        или перед ней для обратного курсора.
+        """
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(
+                self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        condition = Q()
+        equal = {}
+        for field, value in zip(self.ordering, values):
+            field_name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') != reverse else 'gt'
+            condition |= Q(**equal, **{f'{field_name}__{lookup}': value})
+            equal[field_name] = value
+        return condition
+
+    def filter_by_position(self, queryset, position, reverse):
+        try:
+            return queryset.filter(
+                self.get_position_filter(position, reverse))
+        except (ValidationError, ValueError, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def set_positions(self, position, following, reverse):
+        if reverse:
+            self.has_next = position is not None
+            self.has_previous = following is not None
+            self.next_position = position
+            self.previous_position = following
+        else:
+            self.has_next = following is not None
+            self.has_previous = position is not None
+            self.next_position = following
+            self.previous_position = position
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse, position = (False, None) if self.cursor is None else (
+            self.cursor.reverse, self.cursor.position)
+        queryset = queryset.order_by(
+            *(reverse_ordering(self.ordering) if reverse
+              else self.ordering))
+        if position is not None:
+            queryset = self.filter_by_position(queryset, position, reverse)
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        following = None
+        if len(results) > len(self.page):
+            following = self._get_position_from_instance(
+                results[-1], self.ordering)
+        if reverse:
+            self.page.reverse()
+        self.set_positions(position, following, reverse)
+        self.display_page_controls = self.has_previous or self.has_next
+        return self.page
+
+
 class CustomPagination(PageNumberPagination):
+    """Постраничная пагинация ?page=&limit=.
+
+    С параметром ?cursor= (для первой страницы — пустым) переключается
+    на пагинацию по курсору без OFFSET и COUNT(*). С ?count=false
+    общее число не считается: наличие следующей страницы определяется
+    выборкой limit + 1 строк. Для списков пользователя (действия
+    view.exact_count_actions и фильтры view.exact_count_params) число
+    считается точно, для остальных берётся приблизительное.
+    """
+
+    django_paginator_class = CachedCountPaginator
     page_size = REST_FRAMEWORK['PAGE_SIZE']
     page_size_query_param = 'limit'
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    cursor_pagination = None
+    probe = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param in request.query_params:
+            return self.paginate_by_cursor(queryset, request, view)
+        if request.query_params.get(self.count_query_param) == 'false':
+            return self.paginate_by_probe(queryset, request)
+        if self.needs_exact_count(request, view):
+            self.django_paginator_class = ExactCountPaginator
+        return super().paginate_queryset(queryset, request, view)
+
+    def needs_exact_count(self, request, view):
+        """Точное число для списков пользователя: действия view из
+        exact_count_actions и фильтры из exact_count_params.
+        """
+        if getattr(view, 'action', None) in getattr(
+                view, 'exact_count_actions', ()):
+            return True
+        return any(param in request.query_params
+                   for param in getattr(view, 'exact_count_params', ()))
+
+    @property
+    def display_page_controls(self):
+        if self.cursor_pagination is not None:
+            return self.cursor_pagination.display_page_controls
+        return self.__dict__.get('display_page_controls', False)
+
+    @display_page_controls.setter
+    def display_page_controls(self, value):
+        self.__dict__['display_page_controls'] = value
+
+    def paginate_by_cursor(self, queryset, request, view):
+        self.cursor_pagination = KeysetPagination()
+        self.cursor_pagination.cursor_query_param = self.cursor_query_param
+        self.cursor_pagination.ordering = get_keyset_ordering(queryset)
+        return self.cursor_pagination.paginate_queryset(
+            queryset, request, view)
+
+    def paginate_by_probe(self, queryset, request):
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        try:
+            page_number = int(
+                request.query_params.get(self.page_query_param, 1))
+        except ValueError:
+            page_number = 0
+        if page_number < 1:
+            raise NotFound(self.invalid_page_message.format(
+                page_number=page_number, message='Invalid page number'))
+        offset = (page_number - 1) * page_size
+        rows = list(queryset[offset:offset + page_size + 1])
+        self.probe = True
+        self.request = request
+        self.page_number = page_number
+        self.has_next = len(rows) > page_size
+        return rows[:page_size]
+
+    def get_probe_links(self):
+        url = self.request.build_absolute_uri()
+        next_link = previous_link = None
+        if self.has_next:
+            next_link = replace_query_param(
+                url, self.page_query_param, self.page_number + 1)
+        if self.page_number == 2:
+            previous_link = remove_query_param(url, self.page_query_param)
+        elif self.page_number > 2:
+            previous_link = replace_query_param(
+                url, self.page_query_param, self.page_number - 1)
+        return next_link, previous_link
+
+    def get_paginated_response(self, data):
+        if self.cursor_pagination is not None:
+            return self.cursor_pagination.get_paginated_response(data)
+        if self.probe:
+            next_link, previous_link = self.get_probe_links()
+            return Response(OrderedDict([
+                ('next', next_link),
+                ('previous', previous_link),
+                ('results', data),
+            ]))
+        return super().get_paginated_response(data)
+
+    def to_html(self):
+        if self.cursor_pagination is not None:
+            return self.cursor_pagination.to_html()
+        return super().to_html()
@@ -0,0 +1,178 @@
+"""Профилирование запросов: SQL-запросы, время БД и сериализации.
+
+Включается настройкой REQUEST_PROFILING. Результат отдаётся
+в заголовке Server-Timing и пишется в лог api.profiling строкой JSON;
+потоковые ответы учитываются вместе с телом и только логируются.
+"""
+import json
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from rest_framework.serializers import BaseSerializer
+
+logger = logging.getLogger(__name__)
+
+current_profile = ContextVar('current_profile', default=None)
+
+
+class QueryBudgetExceededError(Exception):
+    """Запрос выполнил больше SQL-запросов, чем разрешено бюджетом."""
+
+
+class RequestProfile:
+    """Метрики одного HTTP-запроса."""
+
+    def __init__(self):
+        self.view = None
+        self.queries = Counter()
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self.started = time.perf_counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        """Обёртка connection.execute_wrapper, учитывающая запрос."""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries[sql] += 1
+
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+
+    @property
+    def duplicate_count(self):
+        return self.query_count - len(self.queries)
+
+    def as_dict(self):
+        duplicates = [
+            {'sql': sql[:200], 'count': count}
+            for sql, count in self.queries.most_common(3) if count > 1
+        ]
+        return {
+            'view': self.view,
+            'queries': self.query_count,
+            'duplicates': self.duplicate_count,
+            'db_ms': round(self.db_time * 1000, 1),
+            'serializer_ms': round(self.serializer_time * 1000, 1),
+            'total_ms': round(
+                (time.perf_counter() - self.started) * 1000, 1),
+            'top_duplicates': duplicates,
+        }
+
+
+def get_view_name(view_func):
+    """Имя view вида 'RecipeViewSet.list' для логов и бюджетов."""
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return f'{view_func.__module__}.{view_func.__name__}'
+    return view_class.__name__
+
+
+def profile_serializer_data(data):
+    """Оборачивает BaseSerializer.data, учитывая время внешней
+    сериализации; вложенные сериализаторы входят в неё же.
+    """
+
+    def profiled_data(serializer):
+        profile = current_profile.get()
+        if profile is None or profile.serializer_depth:
+            return data.fget(serializer)
+        profile.serializer_depth += 1
+        started = time.perf_counter()
+        try:
+            return data.fget(serializer)
+        finally:
+            profile.serializer_time += time.perf_counter() - started
+            profile.serializer_depth -= 1
+
+    profiled_data.profiled = True
+    return property(profiled_data)
+
+
+class ProfilingMiddleware:
+    """Считает SQL-запросы, время БД и сериализации каждого запроса
+    и проверяет бюджеты REQUEST_PROFILING_QUERY_BUDGETS.
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_PROFILING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if not getattr(BaseSerializer.data.fget, 'profiled', False):
+            BaseSerializer.data = profile_serializer_data(
+                BaseSerializer.data)
+
+    def track_queries(self, profile):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(profile))
+        return stack
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        try:
+            with self.track_queries(profile):
+                response = self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        if response.streaming:
+            response.streaming_content = self.profile_stream(
+                profile, response.streaming_content)
+            return response
+        data = profile.as_dict()
+        response['Server-Timing'] = self.get_server_timing(data)
+        self.report(data)
+        return response
+
+    def profile_stream(self, profile, content):
+        """Отдаёт тело потокового ответа, продолжая считать запросы;
+        итог пишется в лог и проверяется бюджетом, когда тело
+        отдано целиком. Заголовок Server-Timing к этому времени уже
+        отправлен, поэтому для таких ответов он не ставится.
+        """
+        with self.track_queries(profile):
+            yield from content
+        data = profile.as_dict()
+        data['streaming'] = True
+        self.report(data)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = current_profile.get()
+        if profile is None:
+            return
+        view_name = get_view_name(view_func)
+        actions = getattr(view_func, 'actions', None)
+        if actions:
+            action = actions.get(request.method.lower())
+            view_name = f'{view_name}.{action}'
+        profile.view = view_name
+
+    def get_server_timing(self, data):
+        return ', '.join((
+            f'db;dur={data["db_ms"]};desc="{data["queries"]} queries, '
+            f'{data["duplicates"]} duplicates"',
+            f'serializer;dur={data["serializer_ms"]}',
+            f'total;dur={data["total_ms"]}',
+        ))
+
+    def report(self, data):
+        logger.info(json.dumps(data, ensure_ascii=False))
+        budget = settings.REQUEST_PROFILING_QUERY_BUDGETS.get(data['view'])
+        if budget is None or data['queries'] <= budget:
+            return
+        message = (f'{data["view"]}: {data["queries"]} SQL-запросов '
+                   f'при бюджете {budget}')
+        if settings.REQUEST_PROFILING_RAISE:
+            raise QueryBudgetExceededError(message)
+        logger.warning(message)
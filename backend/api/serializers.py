@@ -2,15 +2,38 @@ import base64
 import logging
 
 from django.core.files.base import ContentFile
-from django.shortcuts import get_object_or_404
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Case, Value, When, prefetch_related_objects
 from djoser.serializers import UserCreateSerializer, UserSerializer
 from rest_framework import serializers
 
 from foodgram.settings import REST_FRAMEWORK  # isort: split
+from recipes.images import get_derivative_names, schedule_derivatives
 from recipes.models import (Cart, Favorite, Ingredient, Recipe,
-                            RecipeIngredient, Tag)
+                            RecipeIngredient, ShoppingListItem, Tag,
+                            get_recipe_amounts, recipe_related_lookups)
+from recipes.search import update_search_index
 from users.models import Subscribe, User
 
+RECIPE_IDS_MAX_LENGTH = 100
+PANTRY_MAX_INGREDIENTS = 200
+PANTRY_MAX_MISSING = 5
+PANTRY_MAX_LIMIT = 50
+
+
+def get_recipes_limit(request):
+    """Число рецептов автора из параметра recipes_limit."""
+    recipes_limit = request.query_params.get('recipes_limit')
+    if recipes_limit is None:
+        return REST_FRAMEWORK['PAGE_SIZE']
+    try:
+        return int(recipes_limit)
+    except ValueError as exc:
+        logging.exception(f'Параметр recipes_limit должен'
+                          f' быть числом: {exc}')
+        return REST_FRAMEWORK['PAGE_SIZE']
+
 
 class CustomUserSerializer(UserSerializer):
     """Сериализатор для модели User."""
@@ -20,9 +43,12 @@ class CustomUserSerializer(UserSerializer):
     class Meta():
         model = User
         fields = ('email', 'id', 'username', 'first_name', 'last_name',
-                  'is_subscribed')
+                  'is_subscribed', 'recipes_count', 'followers_count')
 
     def get_is_subscribed(self, obj):
+        is_subscribed = getattr(obj, 'is_subscribed', None)
+        if is_subscribed is not None:
+            return is_subscribed
         request = self.context['request']
         user = request.user
         author = obj
@@ -55,11 +81,17 @@ class SubscribeSerializer(CustomUserSerializer):
         read_only=True)
     is_subscribed = serializers.SerializerMethodField()
     recipes = serializers.SerializerMethodField(source='author.recipes')
-    recipes_count = serializers.SerializerMethodField()
+    recipes_count = serializers.IntegerField(
+        source='author.recipes_count',
+        read_only=True)
+    followers_count = serializers.IntegerField(
+        source='author.followers_count',
+        read_only=True)
 
     class Meta:
         fields = ('email', 'id', 'username', 'first_name', 'last_name',
-                  'is_subscribed', 'recipes', 'recipes_count')
+                  'is_subscribed', 'recipes', 'recipes_count',
+                  'followers_count')
         model = Subscribe
 
     def to_internal_value(self, data):
@@ -76,32 +108,17 @@ class SubscribeSerializer(CustomUserSerializer):
         return data
 
     def get_is_subscribed(self, obj):
-        user = self.context['request'].user
-        author = obj.author
-        if Subscribe.objects.filter(user=user, author=author).exists():
-            return True
-        return False
+        return obj.user_id == self.context['request'].user.id
 
     def get_recipes(self, obj):
-        request = self.context['request']
-        author = obj.author
-        recipes_limit = request.query_params.get('recipes_limit')
-        if recipes_limit is None:
-            limit = REST_FRAMEWORK['PAGE_SIZE']
+        recipes_by_author = self.context.get('recipes_by_author')
+        if recipes_by_author is not None:
+            recipes = recipes_by_author.get(obj.author_id, [])
         else:
-            try:
-                limit = int(recipes_limit)
-            except ValueError as exc:
-                limit = REST_FRAMEWORK['PAGE_SIZE']
-                logging.exception(f'Параметр recipes_limit должен'
-                                  f' быть числом: {exc}')
-        recipes = author.recipes.all()[:limit]
+            limit = get_recipes_limit(self.context['request'])
+            recipes = obj.author.recipes.all()[:limit]
         return RecipeSubscribeFavoriteCartSerializer(recipes, many=True).data
 
-    def get_recipes_count(self, obj):
-        author = obj.author
-        return author.recipes.count()
-
 
 class Base64ImageField(serializers.ImageField):
     """Сериализатор для декодирования картинки из base64."""
@@ -114,19 +131,69 @@ class Base64ImageField(serializers.ImageField):
         return super().to_internal_value(data)
 
 
+class ImageDerivativesField(serializers.ReadOnlyField):
+    """Ссылки на уменьшенные копии картинки рецепта
+    вида {size: {'webp': url, 'jpeg': url}}.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        super().__init__(**kwargs)
+
+    def to_representation(self, recipe):
+        request = self.context.get('request')
+        urls = {}
+        for size, names in get_derivative_names(recipe).items():
+            urls[size] = {}
+            for extension, name in names.items():
+                url = default_storage.url(name) if name else None
+                if url and request is not None:
+                    url = request.build_absolute_uri(url)
+                urls[size][extension] = url
+        return urls
+
+
 class RecipeSubscribeFavoriteCartSerializer(serializers.ModelSerializer):
     """Сериализатор модели Recipe
     используемый для Subscribe, Favorite, Cart.
     """
 
     image = Base64ImageField(required=False, allow_null=True)
+    images = ImageDerivativesField()
 
     class Meta:
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'images', 'cooking_time')
         read_only_fields = ('name', 'cooking_time')
         model = Recipe
 
 
+class RecipeIdsSerializer(serializers.Serializer):
+    """Сериализатор списка id рецептов для пакетных запросов
+    к избранному и корзине.
+    """
+
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=RECIPE_IDS_MAX_LENGTH)
+
+
+class PantrySerializer(serializers.Serializer):
+    """Сериализатор параметров подбора рецептов по имеющимся
+    ингредиентам.
+    """
+
+    ingredients = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=PANTRY_MAX_INGREDIENTS)
+    missing = serializers.IntegerField(
+        min_value=0, max_value=PANTRY_MAX_MISSING, default=0)
+    limit = serializers.IntegerField(
+        min_value=1, max_value=PANTRY_MAX_LIMIT,
+        default=REST_FRAMEWORK['PAGE_SIZE'])
+
+
 class IngredientSerializer(serializers.ModelSerializer):
     """Сериализатор для модели Ingredient."""
 
@@ -165,22 +232,35 @@ class RecipeReadSerializer(serializers.ModelSerializer):
         source='recipeingredient')
     author = CustomUserSerializer(read_only=True)
     image = Base64ImageField(required=False, allow_null=True)
+    images = ImageDerivativesField()
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
 
     class Meta:
         fields = ('id', 'tags', 'author', 'ingredients', 'is_favorited',
-                  'is_in_shopping_cart', 'name', 'image', 'text',
-                  'cooking_time')
+                  'is_in_shopping_cart', 'name', 'image', 'images', 'text',
+                  'cooking_time', 'favorites_count', 'carts_count')
         model = Recipe
 
+    def to_representation(self, instance):
+        is_author_subscribed = getattr(instance, 'is_author_subscribed', None)
+        if is_author_subscribed is not None:
+            instance.author.is_subscribed = is_author_subscribed
+        return super().to_representation(instance)
+
     def get_is_favorited(self, obj):
+        is_favorited = getattr(obj, 'is_favorited', None)
+        if is_favorited is not None:
+            return is_favorited
         user = self.context['request'].user
         if user.is_anonymous:
             return False
         return Favorite.objects.filter(user=user, recipe=obj).exists()
 
     def get_is_in_shopping_cart(self, obj):
+        is_in_shopping_cart = getattr(obj, 'is_in_shopping_cart', None)
+        if is_in_shopping_cart is not None:
+            return is_in_shopping_cart
         user = self.context['request'].user
         if user.is_anonymous:
             return False
@@ -195,20 +275,27 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
         source='recipeingredient')
     author = CustomUserSerializer(read_only=True)
     image = Base64ImageField(required=False, allow_null=True)
+    images = ImageDerivativesField()
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
 
     class Meta:
         fields = ('id', 'tags', 'author', 'ingredients', 'is_favorited',
-                  'is_in_shopping_cart', 'name', 'image', 'text',
-                  'cooking_time')
+                  'is_in_shopping_cart', 'name', 'image', 'images', 'text',
+                  'cooking_time', 'favorites_count', 'carts_count')
         model = Recipe
 
     def get_is_favorited(self, obj):
+        is_favorited = getattr(obj, 'is_favorited', None)
+        if is_favorited is not None:
+            return is_favorited
         user = self.context['request'].user
         return Favorite.objects.filter(user=user, recipe=obj).exists()
 
     def get_is_in_shopping_cart(self, obj):
+        is_in_shopping_cart = getattr(obj, 'is_in_shopping_cart', None)
+        if is_in_shopping_cart is not None:
+            return is_in_shopping_cart
         user = self.context['request'].user
         return Cart.objects.filter(user=user, recipe=obj).exists()
 
@@ -218,63 +305,90 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
         if len(ids) != len(set(ids)):
             raise serializers.ValidationError('Ингредиенты в рецепте'
                                               ' должны быть уникальными')
-        if len(ids) != Ingredient.objects.filter(id__in=ids).count():
-            raise serializers.ValidationError('Указан неверный id ингредиента')
+        missing = set(ids) - Ingredient.objects.only('pk').in_bulk(ids).keys()
+        if missing:
+            raise serializers.ValidationError(
+                f'Указан неверный id ингредиента: {sorted(missing)}')
         if data.get('cooking_time') < 1:
             raise serializers.ValidationError('Время приготовления должно быть'
                                               ' больше 0')
         return data
 
-    def create_ingredients(self, ingredients, recipe):
-        ingredient_ids = []
-        recipeingredient_list = []
-        for ingredient in ingredients:
-            pk = ingredient.get('ingredient').get('id')
-            current_ingredient = get_object_or_404(Ingredient, pk=pk)
-            amount = ingredient.get('amount')
-            new_recipeingredient = RecipeIngredient(
-                ingredient=current_ingredient,
-                recipe=recipe,
-                amount=amount)
-            ingredient_ids.append(current_ingredient.pk)
-            recipeingredient_list.append(new_recipeingredient)
-        RecipeIngredient.objects.bulk_create(recipeingredient_list)
-        return ingredient_ids
-
-    def update_tags(self, tags):
-        return [tag.id for tag in tags]
-
+    def get_amounts(self, ingredients):
+        """Количества ингредиентов вида {ingredient_id: amount}."""
+        return {ingredient['ingredient']['id']: ingredient['amount']
+                for ingredient in ingredients}
+
+    def set_ingredients(self, recipe, amounts, old_amounts):
+        """Приводит ингредиенты рецепта к amounts, меняя только
+        удалённые, изменённые и добавленные строки.
+        """
+        recipe_ingredients = RecipeIngredient.objects.filter(recipe=recipe)
+        removed = old_amounts.keys() - amounts.keys()
+        if removed:
+            recipe_ingredients.filter(ingredient_id__in=removed).delete()
+        changed = {pk: amount for pk, amount in amounts.items()
+                   if pk in old_amounts and old_amounts[pk] != amount}
+        if changed:
+            recipe_ingredients.filter(ingredient_id__in=changed).update(
+                amount=Case(*[When(ingredient_id=pk, then=Value(amount))
+                              for pk, amount in changed.items()]))
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(recipe=recipe, ingredient_id=pk, amount=amount)
+            for pk, amount in amounts.items() if pk not in old_amounts)
+
+    def set_tags(self, recipe, tags, old_tag_ids=()):
+        """Приводит теги рецепта к tags, меняя только разницу."""
+        tag_ids = {tag.id for tag in tags}
+        through = Recipe.tags.through.objects
+        removed = set(old_tag_ids) - tag_ids
+        if removed:
+            through.filter(recipe=recipe, tag_id__in=removed).delete()
+        through.bulk_create(
+            Recipe.tags.through(recipe_id=recipe.pk, tag_id=pk)
+            for pk in tag_ids - set(old_tag_ids))
+
+    @transaction.atomic
     def create(self, validated_data):
-        ingredients = validated_data.pop('recipeingredient')
+        amounts = self.get_amounts(validated_data.pop('recipeingredient'))
         tags = validated_data.pop('tags')
         recipe = Recipe.objects.create(**validated_data)
-        recipe.save()
-        recipe.tags.add(*tags)
-        recipe.ingredients.set(self.create_ingredients(ingredients, recipe))
+        self.set_tags(recipe, tags)
+        self.set_ingredients(recipe, amounts, {})
+        update_search_index([recipe.pk])
+        schedule_derivatives(recipe)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        tags = validated_data.pop('tags', [])
-        ingredients = validated_data.pop('recipeingredient', [])
-        RecipeIngredient.objects.filter(recipe=instance).delete()
-        instance.ingredients.set(
-            self.create_ingredients(ingredients, instance))
-        instance.tags.set(self.update_tags(tags))
+        if 'recipeingredient' in validated_data:
+            amounts = self.get_amounts(
+                validated_data.pop('recipeingredient'))
+            old_amounts = get_recipe_amounts(instance)
+            self.set_ingredients(instance, amounts, old_amounts)
+            ShoppingListItem.objects.update_recipe(
+                instance, old_amounts, amounts)
+        if 'tags' in validated_data:
+            self.set_tags(
+                instance, validated_data.pop('tags'),
+                Recipe.tags.through.objects.filter(
+                    recipe=instance).values_list('tag_id', flat=True))
         fields = ['name', 'image', 'text', 'cooking_time']
         for field in fields:
-            try:
+            if field in validated_data:
                 setattr(instance, field, validated_data[field])
-            except KeyError as exc:
-                logging.exception(f'Ошибка валидации: {exc}')
         instance.save()
+        update_search_index([instance.pk])
+        if 'image' in validated_data:
+            schedule_derivatives(instance)
         return instance
 
     def to_representation(self, instance):
+        prefetch_related_objects([instance], *recipe_related_lookups())
+        is_author_subscribed = getattr(instance, 'is_author_subscribed', None)
+        if is_author_subscribed is not None:
+            instance.author.is_subscribed = is_author_subscribed
         representation = super().to_representation(instance)
-        tags = instance.tags.all()
-        for i, tag in enumerate(tags):
-            representation['tags'][i] = {'id': tag.id,
-                                         'name': tag.name,
-                                         'color': tag.color,
-                                         'slug': tag.slug}
+        representation['tags'] = TagSerializer(
+            instance.tags.all(), many=True).data
         return representation
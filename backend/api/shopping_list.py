@@ -0,0 +1,150 @@
+"""Выгрузка списка покупок в форматах txt, csv, json и pdf.
+
+Текстовые форматы отдаются потоком: строки формируются генератором
+по мере чтения агрегированного queryset, поэтому время до первого байта
+и расход памяти не зависят от размера корзины.
+"""
+import csv
+import datetime
+import io
+import json
+import os
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+except ImportError:
+    canvas = None
+
+PDF_FONT_NAME = 'ShoppingListFont'
+PDF_FONT_SIZE = 12
+PDF_MARGIN = 50
+
+
+class ShoppingListRenderer(BaseRenderer):
+    """Рендерер для выбора формата через ?format=.
+
+    Сам список формирует view, рендерер используется только
+    для ответов с ошибками.
+    """
+
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, dict) and 'detail' in data:
+            data = data['detail']
+        return str(data).encode('utf-8')
+
+
+class TextRenderer(ShoppingListRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+
+class CSVRenderer(ShoppingListRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class PDFRenderer(ShoppingListRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
+
+
+SHOPPING_LIST_RENDERERS = (TextRenderer, CSVRenderer, JSONRenderer)
+if canvas is not None:
+    SHOPPING_LIST_RENDERERS += (PDFRenderer,)
+
+
+class Echo:
+    """Буфер для csv.writer, возвращающий записанную строку."""
+
+    def write(self, value):
+        return value
+
+
+def get_title():
+    nowtime = datetime.datetime.now().strftime("%d/%m/%Y")
+    return f'Foodgram {nowtime}.'
+
+
+def iter_txt(ingredients):
+    yield f'{get_title()}\n'
+    for name, measurement_unit, amount in ingredients:
+        yield f'* {name} - {amount} {measurement_unit}\n'
+
+
+def iter_csv(ingredients):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('name', 'amount', 'measurement_unit'))
+    for name, measurement_unit, amount in ingredients:
+        yield writer.writerow((name, amount, measurement_unit))
+
+
+def iter_json(ingredients):
+    yield '['
+    separator = ''
+    for name, measurement_unit, amount in ingredients:
+        item = {'name': name, 'measurement_unit': measurement_unit,
+                'amount': amount}
+        yield separator + json.dumps(item, ensure_ascii=False)
+        separator = ', '
+    yield ']'
+
+
+def build_pdf(ingredients):
+    font_name = 'Helvetica'
+    if os.path.exists(settings.SHOPPING_LIST_PDF_FONT):
+        if PDF_FONT_NAME not in pdfmetrics.getRegisteredFontNames():
+            pdfmetrics.registerFont(
+                TTFont(PDF_FONT_NAME, settings.SHOPPING_LIST_PDF_FONT))
+        font_name = PDF_FONT_NAME
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+    width, height = A4
+    y = height - PDF_MARGIN
+    pdf.setFont(font_name, PDF_FONT_SIZE)
+    for line in iter_txt(ingredients):
+        if y < PDF_MARGIN:
+            pdf.showPage()
+            pdf.setFont(font_name, PDF_FONT_SIZE)
+            y = height - PDF_MARGIN
+        pdf.drawString(PDF_MARGIN, y, line.rstrip('\n'))
+        y -= PDF_FONT_SIZE * 1.5
+    pdf.save()
+    return buffer.getvalue()
+
+
+STREAMS = {
+    'txt': iter_txt,
+    'csv': iter_csv,
+    'json': iter_json,
+}
+
+
+def shopping_list_response(ingredients, renderer):
+    """Ответ со списком покупок в формате выбранного рендерера.
+
+    ingredients — итерируемый объект кортежей
+    (название, единица измерения, количество).
+    """
+    if renderer.format == 'pdf':
+        response = HttpResponse(build_pdf(ingredients),
+                                content_type=renderer.media_type)
+    else:
+        chunks = STREAMS[renderer.format](ingredients)
+        response = StreamingHttpResponse(
+            (chunk.encode('utf-8') for chunk in chunks),
+            content_type=f'{renderer.media_type}; charset=utf-8')
+    response['Content-Disposition'] = (
+        f'attachment; filename="shopping_list.{renderer.format}"')
+    return response
@@ -1,8 +1,8 @@
-import datetime
+import hashlib
 
-from django.db.models import Sum
-from django.http import HttpResponse
+from django.db import transaction
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser import utils
 from djoser.conf import settings
@@ -12,15 +12,34 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 
 from recipes.models import (Cart, Favorite,  # isort: split
-                            Ingredient, Recipe, Tag)  # isort: split
+                            Ingredient, Recipe, RecipeIngredient,
+                            ShoppingListItem, Tag,
+                            get_recipe_amounts, lock_users)  # isort: split
+from recipes.counters import change_counter, subtract_users  # isort: split
+from recipes.feed import (Feed, remove_author,  # isort: split
+                          schedule_backfill, schedule_fan_out)
+from recipes.pantry import pantry_index  # isort: split
+from recipes.search import update_search_index  # isort: split
+from recipes.similar import similar_recipes_index  # isort: split
 from users.models import Subscribe, User  # isort: split
-from .filters import IngredientFilter, RecipeFilter
+from .cache import RenderedListMixin
+from .filters import IngredientFilter, RecipeFilter, RecipeSearchFilter
+from .ingredient_index import ingredient_index
 from .pagination import CustomPagination
 from .permissions import IsAuthOrReadOnly
 from .serializers import (CustomUserSerializer, IngredientSerializer,
-                          RecipeCreateUpdateSerializer, RecipeReadSerializer,
+                          PantrySerializer, RecipeCreateUpdateSerializer,
+                          RecipeIdsSerializer, RecipeReadSerializer,
                           RecipeSubscribeFavoriteCartSerializer,
-                          SubscribeSerializer, TagSerializer)
+                          SubscribeSerializer, TagSerializer,
+                          get_recipes_limit)
+from .shopping_list import SHOPPING_LIST_RENDERERS, shopping_list_response
+
+SIMILAR_RECIPES_LIMIT = 10
+SIMILAR_RECIPES_MAX_LIMIT = 50
+# Запас строк индекса продуктов на рецепты, удалённые после его
+# синхронизации
+PANTRY_OVERFETCH = 10
 
 
 class CustomTokenCreateView(TokenCreateView):
@@ -42,6 +61,15 @@ class SubscribeViewSet(UserViewSet):
     queryset = User.objects.all()
     serializer_class = CustomUserSerializer
     pagination_class = CustomPagination
+    exact_count_actions = ('subscriptions',)
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        ShoppingListItem.objects.remove_carts(
+            Cart.objects.filter(recipe__author=instance).exclude(
+                user=instance))
+        subtract_users([instance.pk])
+        super().perform_destroy(instance)
 
     @action(detail=True, methods=('POST', 'DELETE'),
             serializer_class=SubscribeSerializer)
@@ -53,7 +81,10 @@ class SubscribeViewSet(UserViewSet):
         serializer = self.get_serializer(data=data)
         if request.method == 'POST':
             if serializer.is_valid():
-                serializer.save()
+                with transaction.atomic():
+                    serializer.save()
+                    change_counter(User, 'followers_count', {author.pk: 1})
+                    schedule_backfill(user, author)
                 return Response(serializer.data,
                                 status=status.HTTP_201_CREATED)
             return Response(serializer.errors,
@@ -61,23 +92,39 @@ class SubscribeViewSet(UserViewSet):
         subsribe = Subscribe.objects.filter(user=user, author=author)
         if not subsribe.exists():
             raise serializers.ValidationError("Такой подписки не существует")
-        subsribe.delete()
+        with transaction.atomic():
+            subsribe.delete()
+            change_counter(User, 'followers_count', {author.pk: -1})
+            remove_author(user, author)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=False, serializer_class=SubscribeSerializer,
             pagination_class=CustomPagination)
     def subscriptions(self, request):
         user = self.request.user
-        new_queryset = user.subscriber.all()
+        new_queryset = user.subscriber.select_related('author')
         page = self.paginate_queryset(new_queryset)
+        subscriptions = new_queryset if page is None else page
+        context = self.get_serializer_context()
+        context['recipes_by_author'] = self.get_recipes_by_author(
+            subscriptions)
+        serializer = self.get_serializer(
+            subscriptions, many=True, context=context)
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
-        serializer = self.get_serializer(new_queryset, many=True)
         return Response(serializer.data)
 
+    def get_recipes_by_author(self, subscriptions):
+        author_ids = [subscription.author_id for subscription in subscriptions]
+        recipes_by_author = {}
+        recipes = Recipe.objects.latest_for_authors(
+            author_ids, get_recipes_limit(self.request))
+        for recipe in recipes:
+            recipes_by_author.setdefault(recipe.author_id, []).append(recipe)
+        return recipes_by_author
+
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(RenderedListMixin, viewsets.ReadOnlyModelViewSet):
     """Viewset для эндпоинта ingredients."""
 
     queryset = Ingredient.objects.all()
@@ -86,39 +133,111 @@ class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
     filterset_class = IngredientFilter
     pagination_class = None
 
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if not name:
+            return self.rendered_list(request)
+        return Response(ingredient_index.search(name))
 
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+
+class TagViewSet(RenderedListMixin, viewsets.ReadOnlyModelViewSet):
     """Viewset для эндпоинта tags."""
 
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     pagination_class = None
 
+    def list(self, request, *args, **kwargs):
+        return self.rendered_list(request)
+
 
 class RecipeViewSet(viewsets.ModelViewSet):
     """Viewset для эндпоинтов
-    recipes, recipes/{pk}/favorite, recipes/{pk}/shopping_cart и
-    recipes/download_shopping_cart.
+    recipes, recipes/{pk}/favorite, recipes/{pk}/shopping_cart,
+    recipes/{pk}/similar, recipes/favorite, recipes/shopping_cart,
+    recipes/feed, recipes/pantry и recipes/download_shopping_cart.
     """
 
     queryset = Recipe.objects.all()
     pagination_class = CustomPagination
+    exact_count_params = ('author', 'is_favorited', 'is_in_shopping_cart')
     permission_classes = (IsAuthOrReadOnly,)
-    filter_backends = (DjangoFilterBackend,)
+    filter_backends = (DjangoFilterBackend, RecipeSearchFilter)
     filterset_class = RecipeFilter
 
+    def get_queryset(self):
+        queryset = Recipe.objects.with_user_flags(self.request.user)
+        if self.action in ('list', 'retrieve', 'feed'):
+            return queryset.with_related()
+        return queryset.select_related('author')
+
+    def get_etag(self, pk):
+        """ETag рецепта для текущего пользователя: версии рецепта,
+        автора, тегов и ингредиентов, счётчики рецепта и автора,
+        флаги избранного, корзины и подписки на автора.
+        """
+        try:
+            recipes = Recipe.objects.with_user_flags(
+                self.request.user).with_versions().filter(pk=pk)
+        except (TypeError, ValueError):
+            return None
+        version = recipes.values_list(
+            'updated_at', 'author__updated_at', 'tags_updated_at',
+            'tags_count', 'ingredients_updated_at', 'ingredients_count',
+            'favorites_count', 'carts_count', 'author__recipes_count',
+            'author__followers_count', 'is_favorited', 'is_in_shopping_cart',
+            'is_author_subscribed').first()
+        if version is None:
+            return None
+        digest = hashlib.sha256('|'.join(
+            str(value) for value in version[:-3]).encode()).hexdigest()
+        user_flags = ''.join(str(int(flag)) for flag in version[-3:])
+        return (f'"{pk}-{digest[:32]}-{self.request.user.pk or 0}-'
+                f'{user_flags}"')
+
+    def retrieve(self, request, *args, **kwargs):
+        etag = self.get_etag(kwargs['pk'])
+        if etag is not None:
+            response = get_conditional_response(request, etag=etag)
+            if response is not None:
+                response['ETag'] = etag
+                patch_vary_headers(response, ('Authorization',))
+                return response
+        response = super().retrieve(request, *args, **kwargs)
+        response['ETag'] = etag
+        patch_vary_headers(response, ('Authorization',))
+        return response
+
     def get_serializer_class(self):
         if self.action == 'favorite':
             return RecipeSubscribeFavoriteCartSerializer
-        if self.action == 'shopping_cart':
+        if self.action in ('shopping_cart', 'similar', 'pantry'):
             return RecipeSubscribeFavoriteCartSerializer
+        if self.action in ('favorite_batch', 'shopping_cart_batch'):
+            return RecipeIdsSerializer
         method = self.request.method
         if method == 'GET':
             return RecipeReadSerializer
         return RecipeCreateUpdateSerializer
 
+    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        recipe = serializer.save(author=self.request.user)
+        schedule_fan_out(recipe)
+        change_counter(User, 'recipes_count', {self.request.user.pk: 1})
+        recipe.author.refresh_from_db(fields=('recipes_count',))
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        amounts = get_recipe_amounts(instance)
+        ShoppingListItem.objects.apply_amounts(
+            Cart.objects.filter(recipe=instance).values_list(
+                'user_id', flat=True),
+            {pk: -amount for pk, amount in amounts.items()})
+        pk = instance.pk
+        instance.delete()
+        change_counter(User, 'recipes_count', {instance.author_id: -1})
+        update_search_index([pk])
 
     @action(detail=True, methods=('POST', 'DELETE'))
     def favorite(self, request, pk):
@@ -128,19 +247,26 @@ class RecipeViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(recipe, data=data)
         if request.method == 'POST':
             if serializer.is_valid():
-                if Favorite.objects.filter(user=user, recipe=recipe).exists():
-                    raise serializers.ValidationError(
-                        'Рецепт уже добавлен в избранное')
-                Favorite.objects.create(user=user, recipe=recipe)
-                serializer.save()
+                with transaction.atomic():
+                    lock_users([user.pk])
+                    if Favorite.objects.filter(
+                            user=user, recipe=recipe).exists():
+                        raise serializers.ValidationError(
+                            'Рецепт уже добавлен в избранное')
+                    Favorite.objects.create(user=user, recipe=recipe)
+                    change_counter(Recipe, 'favorites_count', {recipe.pk: 1})
                 return Response(serializer.data,
                                 status=status.HTTP_201_CREATED)
             return Response(serializer.errors,
                             status=status.HTTP_400_BAD_REQUEST)
-        favorite = Favorite.objects.filter(user=user, recipe=recipe)
-        if not favorite.exists():
-            raise serializers.ValidationError('Такого рецепта нет в избранном')
-        favorite.delete()
+        with transaction.atomic():
+            lock_users([user.pk])
+            favorite = Favorite.objects.filter(user=user, recipe=recipe)
+            if not favorite.exists():
+                raise serializers.ValidationError(
+                    'Такого рецепта нет в избранном')
+            favorite.delete()
+            change_counter(Recipe, 'favorites_count', {recipe.pk: -1})
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=True, methods=('POST', 'DELETE'))
@@ -151,34 +277,148 @@ class RecipeViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(recipe, data=data)
         if request.method == 'POST':
             if serializer.is_valid():
-                if Cart.objects.filter(user=user, recipe=recipe).exists():
-                    raise serializers.ValidationError(
-                        'Рецепт уже добавлен в корзину')
-                Cart.objects.create(user=user, recipe=recipe)
-                serializer.save()
+                with transaction.atomic():
+                    lock_users([user.pk])
+                    if Cart.objects.filter(user=user, recipe=recipe).exists():
+                        raise serializers.ValidationError(
+                            'Рецепт уже добавлен в корзину')
+                    Cart.objects.create(user=user, recipe=recipe)
+                    change_counter(Recipe, 'carts_count', {recipe.pk: 1})
+                    ShoppingListItem.objects.add_recipe(user, recipe)
                 return Response(serializer.data,
                                 status=status.HTTP_201_CREATED)
             return Response(serializer.errors,
                             status=status.HTTP_400_BAD_REQUEST)
-        cart = Cart.objects.filter(user=user, recipe=recipe)
-        if not cart.exists():
-            raise serializers.ValidationError('Такого рецепта нет в корзине')
-        cart.delete()
+        with transaction.atomic():
+            lock_users([user.pk])
+            cart = Cart.objects.filter(user=user, recipe=recipe)
+            if not cart.exists():
+                raise serializers.ValidationError(
+                    'Такого рецепта нет в корзине')
+            cart.delete()
+            change_counter(Recipe, 'carts_count', {recipe.pk: -1})
+            ShoppingListItem.objects.remove_recipe(user, recipe)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=True)
+    def similar(self, request, pk):
+        recipe = get_object_or_404(Recipe, pk=pk)
+        try:
+            limit = int(request.query_params.get(
+                'limit', SIMILAR_RECIPES_LIMIT))
+        except ValueError:
+            raise serializers.ValidationError(
+                {'limit': 'Параметр limit должен быть числом'})
+        limit = max(1, min(limit, SIMILAR_RECIPES_MAX_LIMIT))
+        scores = dict(similar_recipes_index.similar(recipe.pk, limit))
+        recipes = sorted(
+            Recipe.objects.filter(pk__in=scores),
+            key=lambda obj: (-scores[obj.pk], -obj.pk))
+        data = self.get_serializer(recipes, many=True).data
+        for item in data:
+            item['similarity'] = round(scores[item['id']], 3)
+        return Response(data)
+
+    @action(detail=False)
+    def pantry(self, request):
+        params = PantrySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        ingredient_ids = params.validated_data['ingredients']
+        limit = params.validated_data['limit']
+        found = pantry_index.search(ingredient_ids,
+                                    params.validated_data['missing'],
+                                    limit + PANTRY_OVERFETCH)
+        recipes = Recipe.objects.in_bulk([pk for pk, _, _ in found])
+        deleted = [pk for pk, _, _ in found if pk not in recipes]
+        if deleted:
+            pantry_index.remove(deleted)
+        found = [row for row in found if row[0] in recipes][:limit]
+        missing_ingredients = {}
+        for recipe_id, ingredient_id in RecipeIngredient.objects.filter(
+                recipe_id__in=[pk for pk, _, _ in found]).exclude(
+                    ingredient_id__in=ingredient_ids).order_by(
+                        'ingredient_id').values_list(
+                            'recipe_id', 'ingredient_id'):
+            missing_ingredients.setdefault(recipe_id, []).append(
+                ingredient_id)
+        data = self.get_serializer(
+            [recipes[pk] for pk, _, _ in found], many=True).data
+        for item, (pk, missing, coverage) in zip(data, found):
+            item['coverage'] = round(coverage, 3)
+            item['missing'] = missing
+            item['missing_ingredients'] = missing_ingredients.get(pk, [])
+        return Response(data)
+
     @action(detail=False, permission_classes=(permissions.IsAuthenticated,))
+    def feed(self, request):
+        """Лента подписок постранично без общего числа рецептов."""
+        feed = Feed(request.user, self.filter_queryset(self.get_queryset()))
+        page = self.paginator.paginate_by_probe(feed, request)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def change_recipes_batch(self, request, model, counter):
+        """Добавляет (POST) или удаляет (DELETE) рецепты из списка ids
+        в избранном или корзине пользователя.
+
+        Вызывается внутри транзакции: строка пользователя блокируется
+        до чтения существующих связей, поэтому изменёнными считаются
+        только действительно добавленные или удалённые строки.
+        Возвращает id изменённых рецептов и ответ с результатом
+        по каждому id.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data['ids']))
+        lock_users([request.user.pk])
+        found = Recipe.objects.only('pk').in_bulk(ids)
+        items = model.objects.filter(user=request.user, recipe_id__in=found)
+        existing = set(items.values_list('recipe_id', flat=True))
+        if request.method == 'POST':
+            changed = [pk for pk in found if pk not in existing]
+            model.objects.bulk_create(
+                [model(user=request.user, recipe_id=pk) for pk in changed])
+            delta, done, skipped = 1, 'added', 'already_added'
+        else:
+            changed = list(existing)
+            if changed:
+                items.delete()
+            delta, done, skipped = -1, 'removed', 'not_added'
+        change_counter(Recipe, counter, {pk: delta for pk in changed})
+        statuses = dict.fromkeys(found, skipped)
+        statuses.update(dict.fromkeys(changed, done))
+        results = [{'id': pk, 'status': statuses.get(pk, 'not_found')}
+                   for pk in ids]
+        return changed, Response({'results': results})
+
+    @action(detail=False, methods=('POST', 'DELETE'), url_path='favorite',
+            url_name='favorite-batch',
+            permission_classes=(permissions.IsAuthenticated,))
+    def favorite_batch(self, request):
+        with transaction.atomic():
+            _, response = self.change_recipes_batch(
+                request, Favorite, 'favorites_count')
+        return response
+
+    @action(detail=False, methods=('POST', 'DELETE'),
+            url_path='shopping_cart', url_name='shopping-cart-batch',
+            permission_classes=(permissions.IsAuthenticated,))
+    def shopping_cart_batch(self, request):
+        with transaction.atomic():
+            changed, response = self.change_recipes_batch(
+                request, Cart, 'carts_count')
+            if request.method == 'POST':
+                ShoppingListItem.objects.add_recipes(request.user, changed)
+            else:
+                ShoppingListItem.objects.remove_recipes(
+                    request.user, changed)
+        return response
+
+    @action(detail=False, permission_classes=(permissions.IsAuthenticated,),
+            renderer_classes=SHOPPING_LIST_RENDERERS)
     def download_shopping_cart(self, request):
-        sum_ingredients = Recipe.objects.filter(
-            cart__user=self.request.user).values(
-                'recipeingredient__ingredient__name',
-                'recipeingredient__ingredient__measurement_unit').order_by(
-                    'recipeingredient__ingredient__name').annotate(
-                    Sum('recipeingredient__amount'))
-        nowtime = datetime.datetime.now().strftime("%d/%m/%Y")
-        list_ingredients = f'Foodgram {nowtime}.\n'
-        for ingr in sum_ingredients:
-            list_ingredients += (
-                f'* {ingr["recipeingredient__ingredient__name"]} - '
-                f'{ingr["recipeingredient__amount__sum"]} '
-                f'{ingr["recipeingredient__ingredient__measurement_unit"]}\n')
-        return HttpResponse(list_ingredients, content_type='text/plain')
+        sum_ingredients = ShoppingListItem.objects.filter(
+            user=self.request.user).order_by('ingredient__name').values_list(
+                'ingredient__name', 'ingredient__measurement_unit', 'amount')
+        return shopping_list_response(sum_ingredients.iterator(),
+                                      request.accepted_renderer)
@@ -40,6 +40,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'foodgram.urls'
@@ -138,6 +139,86 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 6,
 }
 
+# Время жизни индекса ингредиентов в памяти процесса, секунды
+INGREDIENT_INDEX_TTL = 300
+
+# Время жизни кеша отрендеренных списков тегов и ингредиентов, секунды
+RENDERED_LIST_CACHE_TTL = 300
+
+# TTF-шрифт с кириллицей для выгрузки списка покупок в PDF
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT',
+    default='/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+
+# Время жизни закешированного числа объектов в пагинации, секунды
+PAGINATION_COUNT_CACHE_TTL = 30
+
+# Число строк, начиная с которого для неотфильтрованного списка
+# используется оценка из статистики PostgreSQL вместо COUNT(*)
+PAGINATION_ESTIMATE_THRESHOLD = 100000
+
+# Число потоков для фоновых задач; 0 — выполнять задачи синхронно
+BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', default=2))
+
+# Размеры уменьшенных копий картинок рецептов (ширина, высота)
+RECIPE_IMAGE_SIZES = {
+    'card': (400, 300),
+    'detail': (800, 600),
+    'retina': (1600, 1200),
+}
+
+RECIPE_IMAGE_QUALITY = 85
+
+# Длина ленты рецептов от авторов, на которых подписан пользователь
+FEED_TIMELINE_LENGTH = 500
+
+# Рецепты авторов с таким числом подписчиков не рассылаются по лентам,
+# а читаются при запросе ленты
+FEED_CELEBRITY_FOLLOWERS = 10000
+
+# Индекс похожих рецептов (MinHash и LSH по наборам ингредиентов)
+SIMILAR_RECIPES_INDEX_PATH = os.getenv(
+    'SIMILAR_RECIPES_INDEX_PATH',
+    default=os.path.join(BASE_DIR, 'index', 'similar_recipes.npz'))
+# Число LSH-полос и значений подписи в полосе
+SIMILAR_RECIPES_BANDS = 32
+SIMILAR_RECIPES_ROWS = 2
+# Сколько кандидатов ранжировать по точному коэффициенту Жаккара
+SIMILAR_RECIPES_CANDIDATES = 200
+# Как часто подтягивать изменённые рецепты и сохранять индекс, секунды
+SIMILAR_RECIPES_REFRESH_INTERVAL = 10
+SIMILAR_RECIPES_SAVE_INTERVAL = 300
+
+# Инвертированный индекс ингредиентов для подбора рецептов по продуктам
+PANTRY_INDEX_PATH = os.getenv(
+    'PANTRY_INDEX_PATH',
+    default=os.path.join(BASE_DIR, 'index', 'pantry.npz'))
+# Как часто подтягивать изменённые рецепты и сохранять индекс, секунды
+PANTRY_INDEX_REFRESH_INTERVAL = 10
+PANTRY_INDEX_SAVE_INTERVAL = 300
+
+# Профилирование запросов: число SQL-запросов, время БД и сериализации
+# в заголовке Server-Timing и в логе api.profiling
+REQUEST_PROFILING = os.getenv('REQUEST_PROFILING', default='') == 'True'
+
+# Допустимое число SQL-запросов по имени view и action
+REQUEST_PROFILING_QUERY_BUDGETS = {
+    'RecipeViewSet.list': 8,
+    'RecipeViewSet.retrieve': 8,
+    'RecipeViewSet.favorite_batch': 8,
+    'RecipeViewSet.shopping_cart_batch': 16,
+    'SubscribeViewSet.subscriptions': 6,
+    'SubscribeViewSet.list': 6,
+    'SubscribeViewSet.me': 4,
+    'IngredientViewSet.list': 4,
+    'TagViewSet.list': 4,
+}
+
+# Превышение бюджета: True — исключение QueryBudgetExceededError,
+# False — предупреждение в логе
+REQUEST_PROFILING_RAISE = os.getenv(
+    'REQUEST_PROFILING_RAISE', default='') == 'True'
+
 # DJOSER CONFIG
 DJOSER = {
     'LOGIN_FIELD': 'email',
@@ -1,38 +1,140 @@
 from django.contrib import admin
+from django.db import transaction
 
-from .models import Cart, Favorite, Ingredient, Recipe, RecipeIngredient, Tag
+from api.pagination import CachedCountPaginator  # isort: split
+from users.models import User  # isort: split
+from .counters import change_counter, move_counter, subtract_related
+from .models import (Cart, Favorite, Ingredient, Recipe, RecipeIngredient,
+                     ShoppingListItem, Tag, get_recipe_amounts)
+from .search import update_search_index
 
 
 @admin.register(Ingredient)
 class IngredientAdmin(admin.ModelAdmin):
     list_display = ('pk', 'name', 'measurement_unit')
-    list_filter = ('name',)
+    search_fields = ('name',)
+
+
+class RecipeIngredientInline(admin.TabularInline):
+    model = RecipeIngredient
+    autocomplete_fields = ('ingredient',)
+    extra = 1
 
 
 @admin.register(Recipe)
 class RecipeAdmin(admin.ModelAdmin):
     list_display = ('pk', 'author', 'name', 'count_favorite')
-    list_filter = ('author', 'name', 'tags')
+    list_select_related = ('author',)
+    list_filter = ('tags',)
+    search_fields = ('name',)
+    autocomplete_fields = ('author', 'tags')
+    inlines = (RecipeIngredientInline,)
+    show_full_result_count = False
+    paginator = CachedCountPaginator
 
+    @admin.display(description='В избранном', ordering='favorites_count')
     def count_favorite(self, obj):
-        return obj.favorite.count()
+        return obj.favorites_count
+
+    @transaction.atomic
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        move_counter(User, 'recipes_count', form.initial.get('author'),
+                     obj.author_id)
+
+    def save_related(self, request, form, formsets, change):
+        old_amounts = get_recipe_amounts(form.instance) if change else {}
+        super().save_related(request, form, formsets, change)
+        ShoppingListItem.objects.update_recipe(form.instance, old_amounts)
+        update_search_index([form.instance.pk])
+
+    @transaction.atomic
+    def delete_model(self, request, obj):
+        ShoppingListItem.objects.remove_carts(Cart.objects.filter(recipe=obj))
+        change_counter(User, 'recipes_count', {obj.author_id: -1})
+        pk = obj.pk
+        super().delete_model(request, obj)
+        update_search_index([pk])
+
+    @transaction.atomic
+    def delete_queryset(self, request, queryset):
+        ShoppingListItem.objects.remove_carts(
+            Cart.objects.filter(recipe__in=queryset))
+        subtract_related(User, 'recipes_count', queryset, 'author')
+        pks = list(queryset.values_list('pk', flat=True))
+        super().delete_queryset(request, queryset)
+        update_search_index(pks)
 
 
 @admin.register(Tag)
 class TagAdmin(admin.ModelAdmin):
     list_display = ('pk', 'name', 'color', 'slug')
+    search_fields = ('name', 'slug')
 
 
 @admin.register(RecipeIngredient)
 class RecipeIngredientAdmin(admin.ModelAdmin):
-    list_display = ('pk', 'recipe_id', 'ingredient_id', 'amount')
+    list_display = ('pk', 'recipe', 'ingredient', 'amount')
+    list_select_related = ('recipe', 'ingredient')
+    autocomplete_fields = ('recipe', 'ingredient')
+    show_full_result_count = False
+    paginator = CachedCountPaginator
 
 
 @admin.register(Favorite)
 class FavoriteAdmin(admin.ModelAdmin):
-    list_display = ('pk', 'user_id', 'recipe_id')
+    list_display = ('pk', 'user', 'recipe')
+    list_select_related = ('user', 'recipe')
+    autocomplete_fields = ('user', 'recipe')
+    show_full_result_count = False
+    paginator = CachedCountPaginator
+
+    @transaction.atomic
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        move_counter(Recipe, 'favorites_count', form.initial.get('recipe'),
+                     obj.recipe_id)
+
+    @transaction.atomic
+    def delete_model(self, request, obj):
+        change_counter(Recipe, 'favorites_count', {obj.recipe_id: -1})
+        super().delete_model(request, obj)
+
+    @transaction.atomic
+    def delete_queryset(self, request, queryset):
+        subtract_related(Recipe, 'favorites_count', queryset, 'recipe')
+        super().delete_queryset(request, queryset)
 
 
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
-    list_display = ('pk', 'user_id', 'recipe_id')
+    list_display = ('pk', 'user', 'recipe')
+    list_select_related = ('user', 'recipe')
+    autocomplete_fields = ('user', 'recipe')
+    show_full_result_count = False
+    paginator = CachedCountPaginator
+
+    @transaction.atomic
+    def save_model(self, request, obj, form, change):
+        old = Cart.objects.select_for_update().get(
+            pk=obj.pk) if change else None
+        super().save_model(request, obj, form, change)
+        if old is not None:
+            if (old.user_id, old.recipe_id) == (obj.user_id, obj.recipe_id):
+                return
+            ShoppingListItem.objects.remove_recipe(old.user, old.recipe)
+        ShoppingListItem.objects.add_recipe(obj.user, obj.recipe)
+        move_counter(Recipe, 'carts_count', form.initial.get('recipe'),
+                     obj.recipe_id)
+
+    @transaction.atomic
+    def delete_model(self, request, obj):
+        ShoppingListItem.objects.remove_carts(Cart.objects.filter(pk=obj.pk))
+        change_counter(Recipe, 'carts_count', {obj.recipe_id: -1})
+        super().delete_model(request, obj)
+
+    @transaction.atomic
+    def delete_queryset(self, request, queryset):
+        ShoppingListItem.objects.remove_carts(queryset)
+        subtract_related(Recipe, 'carts_count', queryset, 'recipe')
+        super().delete_queryset(request, queryset)
@@ -0,0 +1,19 @@
+"""Вспомогательные функции для пакетной записи через bulk_create."""
+from django.db import connections
+
+
+def assign_ids(objs, using='default'):
+    """Проставляет первичные ключи объектам перед bulk_create, если СУБД
+    не возвращает их из INSERT (SQLite в Django 3.2).
+
+    Вызывается внутри транзакции: SQLite сериализует запись,
+    поэтому занятые ключи не пересекутся.
+    """
+    features = connections[using].features
+    if not objs or features.can_return_rows_from_bulk_insert:
+        return
+    model = type(objs[0])
+    last = model.objects.using(using).order_by('-pk').values_list(
+        'pk', flat=True).first() or 0
+    for pk, obj in enumerate(objs, start=last + 1):
+        obj.pk = pk
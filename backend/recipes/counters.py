@@ -0,0 +1,95 @@
+from django.apps import apps
+from django.db.models import (Case, Count, F, IntegerField, OuterRef, Subquery,
+                              Value, When)
+from django.db.models.functions import Coalesce
+
+
+def change_counter(model, field, deltas):
+    """Прибавляет к счётчику field объектов model значения deltas
+    вида {pk: delta} одним запросом UPDATE.
+    """
+    deltas = {pk: delta for pk, delta in deltas.items() if delta}
+    if not deltas:
+        return 0
+    delta = Case(
+        *[When(pk=pk, then=Value(delta)) for pk, delta in deltas.items()],
+        output_field=IntegerField())
+    return model.objects.filter(pk__in=deltas).update(
+        **{field: F(field) + delta})
+
+
+def move_counter(model, field, old_pk, new_pk):
+    """Переносит единицу счётчика field с объекта old_pk на new_pk;
+    old_pk равен None для только что созданной связи.
+    """
+    if old_pk == new_pk:
+        return 0
+    deltas = {new_pk: 1}
+    if old_pk is not None:
+        deltas[old_pk] = -1
+    return change_counter(model, field, deltas)
+
+
+def subtract_related(model, field, queryset, related_field):
+    """Уменьшает счётчик field объектов model на число строк queryset,
+    ссылающихся на них через related_field; вызывается до удаления строк.
+    """
+    counts = queryset.order_by().values(related_field).annotate(
+        count=Count('pk')).values_list(related_field, 'count')
+    return change_counter(model, field,
+                          {pk: -count for pk, count in counts})
+
+
+def subtract_users(users):
+    """Вычитает из счётчиков избранное, корзины и подписки
+    пользователей users; вызывается до их каскадного удаления.
+
+    Связи с рецептами самих users и подписки на них пропускаются:
+    их счётчики удаляются вместе с объектами.
+    """
+    recipe = apps.get_model('recipes', 'Recipe')
+    favorites = apps.get_model('recipes', 'Favorite').objects.filter(
+        user__in=users).exclude(recipe__author__in=users)
+    carts = apps.get_model('recipes', 'Cart').objects.filter(
+        user__in=users).exclude(recipe__author__in=users)
+    subscriptions = apps.get_model('users', 'Subscribe').objects.filter(
+        user__in=users).exclude(author__in=users)
+    subtract_related(recipe, 'favorites_count', favorites, 'recipe')
+    subtract_related(recipe, 'carts_count', carts, 'recipe')
+    subtract_related(apps.get_model('users', 'User'), 'followers_count',
+                     subscriptions, 'author')
+
+
+def get_counters():
+    """Описания счётчиков вида (model, field, related_model, related_field)."""
+    recipe = apps.get_model('recipes', 'Recipe')
+    user = apps.get_model('users', 'User')
+    return (
+        (recipe, 'favorites_count', apps.get_model('recipes', 'Favorite'),
+         'recipe'),
+        (recipe, 'carts_count', apps.get_model('recipes', 'Cart'), 'recipe'),
+        (user, 'recipes_count', recipe, 'author'),
+        (user, 'followers_count', apps.get_model('users', 'Subscribe'),
+         'author'),
+    )
+
+
+def get_actual_count(related_model, related_field):
+    """Подзапрос, считающий связанные строки для внешнего объекта."""
+    counts = related_model.objects.filter(
+        **{related_field: OuterRef('pk')}).order_by().values(
+            related_field).annotate(count=Count('pk')).values('count')
+    return Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+
+
+def reconcile_counter(model, field, related_model, related_field,
+                      dry_run=False):
+    """Исправляет разошедшиеся значения счётчика, возвращает их число."""
+    drifted = model.objects.annotate(
+        actual=get_actual_count(related_model, related_field)).exclude(
+            **{field: F('actual')}).values('pk')
+    count = drifted.count()
+    if count and not dry_run:
+        model.objects.filter(pk__in=drifted).update(
+            **{field: get_actual_count(related_model, related_field)})
+    return count
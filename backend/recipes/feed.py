@@ -0,0 +1,173 @@
+"""Лента рецептов от авторов, на которых подписан пользователь.
+
+Новые рецепты рассылаются в таблицу TimelineEntry подписчиков фоновой
+задачей. Длина ленты ограничена FEED_TIMELINE_LENGTH. Рецепты авторов
+с числом подписчиков от FEED_CELEBRITY_FOLLOWERS не рассылаются,
+а подмешиваются к записям ленты при запросе (Feed).
+"""
+import heapq
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from users.models import Subscribe, User  # isort: split
+from .models import Recipe, TimelineEntry
+from .tasks import run_in_background
+from .utils import iter_chunks
+
+BATCH_SIZE = 1000
+
+
+class Feed:
+    """Лента пользователя user из рецептов queryset recipes
+    от новых к старым.
+
+    Лента собирается слиянием двух упорядоченных по (pub_date, id)
+    частей: записей TimelineEntry пользователя, которые читаются
+    по индексу (user, -pub_date), и рецептов авторов, чьи рецепты
+    по лентам не рассылаются. Поддерживаются только срезы [start:stop]:
+    из каждой части читается не больше stop + 1 строк, общее число
+    рецептов не считается.
+    """
+
+    def __init__(self, user, recipes):
+        self.user = user
+        self.recipes = recipes
+
+    def get_timeline(self, size):
+        entries = TimelineEntry.objects.filter(user=self.user)
+        if self.recipes.query.where:
+            entries = entries.filter(recipe__in=self.recipes.values('pk'))
+        return entries.order_by('-pub_date', '-recipe_id').values_list(
+            'pub_date', 'recipe_id')[:size]
+
+    def get_direct(self, size):
+        authors = Subscribe.objects.filter(
+            user=self.user,
+            author__followers_count__gte=settings.FEED_CELEBRITY_FOLLOWERS,
+        ).values('author_id')
+        return self.recipes.filter(author__in=authors).order_by(
+            '-pub_date', '-id').values_list('pub_date', 'id')[:size]
+
+    def get_ids(self, size):
+        """id первых size рецептов ленты.
+
+        Рецепт может оказаться в обеих частях, если автор набрал
+        подписчиков после рассылки, поэтому повторы пропускаются.
+        """
+        merged = heapq.merge(self.get_timeline(size), self.get_direct(size),
+                             reverse=True)
+        return list(dict.fromkeys(
+            recipe_id for _, recipe_id in merged))[:size]
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step is not None or (
+                index.stop is None):
+            raise TypeError('Лента поддерживает только срезы [start:stop]')
+        ids = self.get_ids(index.stop)[index.start:]
+        recipes = self.recipes.in_bulk(ids)
+        return [recipes[pk] for pk in ids if pk in recipes]
+
+
+def get_fan_out_subscriptions():
+    """Подписки на авторов, чьи рецепты рассылаются по лентам."""
+    return Subscribe.objects.filter(
+        author__followers_count__lt=settings.FEED_CELEBRITY_FOLLOWERS)
+
+
+def trim_timelines(user_ids):
+    """Оставляет в лентах пользователей не больше FEED_TIMELINE_LENGTH
+    последних записей.
+    """
+    table = TimelineEntry._meta.db_table
+    for chunk in iter_chunks(user_ids, BATCH_SIZE):
+        ranked = TimelineEntry.objects.filter(
+            user_id__in=chunk).order_by().annotate(
+                row_number=Window(
+                    expression=RowNumber(),
+                    partition_by=F('user_id'),
+                    order_by=(F('pub_date').desc(), F('recipe_id').desc()),
+                )
+        ).values('id', 'row_number')
+        sql, params = ranked.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {table} WHERE id IN '
+                f'(SELECT id FROM ({sql}) ranked WHERE row_number > %s)',
+                (*params, settings.FEED_TIMELINE_LENGTH))
+
+
+def fan_out(recipe_ids):
+    """Добавляет рецепты recipe_ids в ленты подписчиков их авторов."""
+    rows = get_fan_out_subscriptions().filter(
+        author__recipes__in=recipe_ids).order_by().values_list(
+            'user_id', 'author__recipes__id', 'author__recipes__pub_date')
+    user_ids = set()
+    for chunk in iter_chunks(rows.iterator(), BATCH_SIZE):
+        TimelineEntry.objects.bulk_create(
+            (TimelineEntry(user_id=user_id, recipe_id=recipe_id,
+                           pub_date=pub_date)
+             for user_id, recipe_id, pub_date in chunk),
+            ignore_conflicts=True)
+        user_ids.update(user_id for user_id, _, _ in chunk)
+    trim_timelines(sorted(user_ids))
+
+
+def schedule_fan_out(recipe):
+    run_in_background(fan_out, [recipe.pk])
+
+
+def backfill(user_id, author_id):
+    """Добавляет в ленту пользователя последние рецепты автора,
+    на которого он подписался.
+    """
+    if not User.objects.filter(
+            pk=author_id,
+            followers_count__lt=settings.FEED_CELEBRITY_FOLLOWERS).exists():
+        return
+    recipes = Recipe.objects.filter(author_id=author_id).order_by(
+        '-pub_date', '-id').values_list(
+            'id', 'pub_date')[:settings.FEED_TIMELINE_LENGTH]
+    TimelineEntry.objects.bulk_create(
+        (TimelineEntry(user_id=user_id, recipe_id=recipe_id,
+                       pub_date=pub_date)
+         for recipe_id, pub_date in recipes),
+        ignore_conflicts=True)
+    trim_timelines([user_id])
+
+
+def schedule_backfill(user, author):
+    run_in_background(backfill, user.pk, author.pk)
+
+
+def remove_author(user, author):
+    """Убирает из ленты пользователя рецепты автора после отписки."""
+    TimelineEntry.objects.filter(
+        user=user, recipe__in=author.recipes.values('pk')).delete()
+
+
+@transaction.atomic
+def rebuild_timelines():
+    """Пересобирает ленты всех пользователей из подписок."""
+    TimelineEntry.objects.all().delete()
+    ranked = get_fan_out_subscriptions().order_by().annotate(
+        recipe_id=F('author__recipes__id'),
+        recipe_pub_date=F('author__recipes__pub_date'),
+    ).filter(recipe_id__isnull=False).annotate(
+        row_number=Window(
+            expression=RowNumber(),
+            partition_by=F('user_id'),
+            order_by=(F('recipe_pub_date').desc(), F('recipe_id').desc()),
+        )
+    ).values('user_id', 'recipe_id', 'recipe_pub_date', 'row_number')
+    sql, params = ranked.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {TimelineEntry._meta.db_table} '
+            f'(user_id, recipe_id, pub_date) '
+            f'SELECT user_id, recipe_id, recipe_pub_date FROM ({sql}) ranked '
+            f'WHERE row_number <= %s',
+            (*params, settings.FEED_TIMELINE_LENGTH))
+        return cursor.rowcount
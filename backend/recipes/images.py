@@ -0,0 +1,91 @@
+"""Уменьшенные копии картинок рецептов в форматах WebP и JPEG."""
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image
+
+from .models import Recipe
+from .tasks import run_in_background
+
+DERIVATIVES_DIR = 'recipes/derivatives'
+FORMATS = {
+    'webp': 'WEBP',
+    'jpeg': 'JPEG',
+}
+
+
+def get_derivative_name(image_name, size, extension):
+    stem = os.path.splitext(os.path.basename(image_name))[0]
+    return f'{DERIVATIVES_DIR}/{stem}/{size}.{extension}'
+
+
+def render(image, box, image_format):
+    derivative = image.copy()
+    derivative.thumbnail(box, Image.LANCZOS)
+    if image_format == 'JPEG' and derivative.mode != 'RGB':
+        background = Image.new('RGB', derivative.size, (255, 255, 255))
+        rgba = derivative.convert('RGBA')
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        derivative = background
+    buffer = io.BytesIO()
+    derivative.save(buffer, format=image_format,
+                    quality=settings.RECIPE_IMAGE_QUALITY)
+    return buffer.getvalue()
+
+
+def build_derivatives(image_field):
+    """Создаёт недостающие уменьшенные копии картинки и возвращает
+    их имена вида {size: {extension: name}}.
+
+    Копии лежат под именами, производными от имени оригинала, поэтому
+    сохраняются в default_storage, а не в хранилище поля с адресацией
+    по содержимому.
+    """
+    storage = default_storage
+    sizes = {}
+    image = None
+    for size, box in settings.RECIPE_IMAGE_SIZES.items():
+        sizes[size] = {}
+        for extension, image_format in FORMATS.items():
+            name = get_derivative_name(image_field.name, size, extension)
+            if not storage.exists(name):
+                if image is None:
+                    with image_field.open('rb') as source:
+                        image = Image.open(source)
+                        image.load()
+                storage.save(name, ContentFile(
+                    render(image, box, image_format)))
+            sizes[size][extension] = name
+    return sizes
+
+
+def generate_derivatives(recipe_id):
+    recipe = Recipe.objects.only('image').filter(pk=recipe_id).first()
+    if recipe is None or not recipe.image:
+        return
+    derivatives = {
+        'source': recipe.image.name,
+        'sizes': build_derivatives(recipe.image),
+    }
+    Recipe.objects.filter(pk=recipe_id, image=recipe.image.name).update(
+        image_derivatives=derivatives, updated_at=timezone.now())
+
+
+def schedule_derivatives(recipe):
+    run_in_background(generate_derivatives, recipe.pk)
+
+
+def get_derivative_names(recipe):
+    """Имена уменьшенных копий картинки рецепта; пока копии
+    не готовы, для всех размеров возвращается оригинал.
+    """
+    derivatives = recipe.image_derivatives or {}
+    if recipe.image and derivatives.get('source') == recipe.image.name:
+        return derivatives['sizes']
+    original = recipe.image.name if recipe.image else None
+    return {size: {extension: original for extension in FORMATS}
+            for size in settings.RECIPE_IMAGE_SIZES}
@@ -0,0 +1,265 @@
+import io
+import itertools
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (CaptureQueriesContext, override_settings,
+                               setup_test_environment,
+                               teardown_test_environment)
+from recipes.models import Ingredient, Recipe, Tag
+from rest_framework.test import APIClient
+
+from users.models import User  # isort: split
+
+PNG = ('data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABAgMAAABiey'
+       'waAAAACVBMVEUAAAD///9fX1/S0ecCAAAACXBIWXMAAA7EAAAOxAGVKw4bAAAACk'
+       'lEQVQImWNoAAAAggCByxOyYQAAAABJRU5ErkJggg==')
+
+RECIPE_FILTERS = ('author', 'tags', 'is_favorited', 'is_in_shopping_cart')
+
+TRACKED_METRICS = ('p50_ms', 'p95_ms', 'queries', 'memory_kb')
+
+# Разница во времени меньше этого значения считается шумом
+TIME_NOISE_MS = 1.0
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(fraction * (len(values) - 1)))]
+
+
+class Command(BaseCommand):
+    help = ('Прогоняет эндпоинты API через тестовый клиент на тестовой '
+            'базе с синтетическими данными и выводит p50/p95 задержки, '
+            'число SQL-запросов и пик выделенной памяти. Результат '
+            'сохраняется в JSON (--save) и сравнивается с базовым '
+            '(--compare). СУБД задаётся обычными настройками DATABASES.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--recipes', type=int, default=500)
+        parser.add_argument('--ingredients', type=int, default=300)
+        parser.add_argument('--links-per-user', type=int, default=20,
+                            help='Избранное и корзина на пользователя.')
+        parser.add_argument('--subscriptions-per-user', type=int,
+                            default=5)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--only', default='',
+                            help='Запускать сценарии, содержащие строку.')
+        parser.add_argument('--save', help='Сохранить результат в JSON.')
+        parser.add_argument('--compare',
+                            help='Базовый JSON для поиска регрессий.')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Допустимый рост метрики, доля.')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as file:
+                baseline = json.load(file)
+        report = self.run(options)
+        if options['save']:
+            with open(options['save'], 'w', encoding='utf-8') as file:
+                json.dump(report, file, ensure_ascii=False, indent=2)
+            self.stdout.write(f'Результат сохранён в {options["save"]}')
+        if baseline is not None:
+            self.compare(baseline, report, options['threshold'])
+
+    def run(self, options):
+        old_name = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           serialize=False)
+        try:
+            with tempfile.TemporaryDirectory() as media_root:
+                with override_settings(
+                        MEDIA_ROOT=media_root,
+                        PANTRY_INDEX_PATH=os.path.join(
+                            media_root, 'index', 'pantry.npz'),
+                        SIMILAR_RECIPES_INDEX_PATH=os.path.join(
+                            media_root, 'index', 'similar_recipes.npz'),
+                        BACKGROUND_WORKERS=0,
+                        REQUEST_PROFILING=False):
+                    self.seed(options)
+                    results = self.measure_all(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        return {
+            'meta': {
+                'vendor': connection.vendor,
+                'python': platform.python_version(),
+                'volumes': {name: options[name] for name in (
+                    'users', 'recipes', 'ingredients', 'links_per_user',
+                    'subscriptions_per_user', 'seed')},
+                'repeat': options['repeat'],
+            },
+            'results': results,
+        }
+
+    def seed(self, options):
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {i}', measurement_unit='г')
+            for i in range(options['ingredients']))
+        call_command(
+            'generate_fake_data', stdout=io.StringIO(),
+            users=options['users'], recipes=options['recipes'],
+            favorites=options['users'] * options['links_per_user'],
+            carts=options['users'] * options['links_per_user'],
+            subscriptions=(options['users']
+                           * options['subscriptions_per_user']),
+            seed=options['seed'])
+        call_command('rebuild_similar_index', stdout=io.StringIO())
+        call_command('rebuild_pantry_index', stdout=io.StringIO())
+        self.user = User.objects.order_by('-recipes_count', 'pk').first()
+        self.tags = list(Tag.objects.order_by('pk'))
+        self.ingredients = list(Ingredient.objects.order_by('pk'))
+
+    def get_scenarios(self):
+        """Сценарии вида (name, method, url, data_factory)."""
+        user = self.user
+        author = Recipe.objects.order_by('pk').values_list(
+            'author_id', flat=True).first()
+        recipe_id = Recipe.objects.filter(author=user).values_list(
+            'pk', flat=True).first()
+        params = {
+            'author': f'author={author}',
+            'tags': f'tags={self.tags[0].slug}&tags={self.tags[1].slug}',
+            'is_favorited': 'is_favorited=1',
+            'is_in_shopping_cart': 'is_in_shopping_cart=1',
+        }
+        scenarios = []
+        for size in range(len(RECIPE_FILTERS) + 1):
+            for names in itertools.combinations(RECIPE_FILTERS, size):
+                query = '&'.join(params[name] for name in names)
+                scenarios.append((f'recipes_list[{",".join(names)}]', 'get',
+                                  f'/api/recipes/?{query}', None))
+        scenarios += [
+            ('recipes_search', 'get', '/api/recipes/?search=суп', None),
+            ('recipe_detail', 'get', f'/api/recipes/{recipe_id}/', None),
+            ('subscriptions', 'get', '/api/users/subscriptions/', None),
+            ('ingredients_autocomplete', 'get',
+             '/api/ingredients/?name=ингредиент 1', None),
+            ('recipes_pantry', 'get', '/api/recipes/pantry/?' + '&'.join(
+                f'ingredients={ingredient.pk}'
+                for ingredient in self.ingredients[:20]) + '&missing=2',
+             None),
+            ('download_shopping_cart', 'get',
+             '/api/recipes/download_shopping_cart/', None),
+            ('recipe_create', 'post', '/api/recipes/',
+             self.recipe_payload),
+        ]
+        if recipe_id is not None:
+            scenarios.append(('recipe_update', 'patch',
+                              f'/api/recipes/{recipe_id}/',
+                              self.recipe_update_payload))
+        return scenarios
+
+    def recipe_payload(self, iteration, image=True):
+        start = iteration % 2 * 5
+        payload = {
+            'name': f'новый рецепт {iteration}',
+            'text': 'описание',
+            'cooking_time': 10,
+            'tags': [tag.pk for tag in self.tags[iteration % 2::2]],
+            'ingredients': [
+                {'id': ingredient.pk, 'amount': iteration + 1}
+                for ingredient in self.ingredients[start:start + 10]],
+        }
+        if image:
+            payload['image'] = PNG
+        return payload
+
+    def recipe_update_payload(self, iteration):
+        return self.recipe_payload(iteration, image=False)
+
+    def request(self, client, method, url, data):
+        response = getattr(client, method)(url, data, format='json')
+        if response.status_code >= 400:
+            raise CommandError(
+                f'{method.upper()} {url}: {response.status_code}')
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+    def measure(self, client, method, url, data_factory, repeat):
+        iterations = itertools.count()
+
+        def call():
+            data = data_factory(next(iterations)) if data_factory else None
+            return self.request(client, method, url, data)
+
+        call()
+        timings = []
+        queries = 0
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                call()
+                timings.append((time.perf_counter() - started) * 1000)
+            queries = max(queries, len(context.captured_queries))
+        tracemalloc.start()
+        try:
+            call()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return {
+            'p50_ms': round(percentile(timings, 0.5), 2),
+            'p95_ms': round(percentile(timings, 0.95), 2),
+            'queries': queries,
+            'memory_kb': round(peak / 1024, 1),
+        }
+
+    def measure_all(self, options):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        results = {}
+        self.stdout.write(f'{"сценарий":<60} {"p50":>8} {"p95":>8} '
+                          f'{"SQL":>5} {"KiB":>8}')
+        for name, method, url, data_factory in self.get_scenarios():
+            if options['only'] not in name:
+                continue
+            result = self.measure(client, method, url, data_factory,
+                                  options['repeat'])
+            results[name] = result
+            self.stdout.write(
+                f'{name:<60} {result["p50_ms"]:>8} {result["p95_ms"]:>8} '
+                f'{result["queries"]:>5} {result["memory_kb"]:>8}')
+        return results
+
+    def is_regression(self, metric, old, new, threshold):
+        if metric == 'queries':
+            return new > old
+        if metric.endswith('_ms') and new - old < TIME_NOISE_MS:
+            return False
+        return new > old * (1 + threshold)
+
+    def compare(self, baseline, report, threshold):
+        if baseline.get('meta', {}).get('volumes') != report['meta'][
+                'volumes']:
+            self.stderr.write('Объёмы данных отличаются от базовых, '
+                              'сравнение может быть неточным')
+        regressions = []
+        for name, result in report['results'].items():
+            old_result = baseline.get('results', {}).get(name)
+            if old_result is None:
+                continue
+            for metric in TRACKED_METRICS:
+                old, new = old_result.get(metric), result[metric]
+                if old is not None and self.is_regression(
+                        metric, old, new, threshold):
+                    regressions.append(f'{name}.{metric}: {old} -> {new}')
+        for regression in regressions:
+            self.stderr.write(regression)
+        if regressions:
+            raise CommandError(f'Регрессий: {len(regressions)}')
+        self.stdout.write('Регрессий нет')
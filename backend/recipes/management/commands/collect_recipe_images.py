@@ -0,0 +1,62 @@
+import os
+import posixpath
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from recipes.images import DERIVATIVES_DIR
+from recipes.models import Recipe
+from recipes.storage import recipe_image_storage
+
+IMAGES_DIR = 'recipes'
+
+
+def walk(storage, path):
+    directories, files = storage.listdir(path)
+    for name in files:
+        yield posixpath.join(path, name)
+    for directory in directories:
+        yield from walk(storage, posixpath.join(path, directory))
+
+
+class Command(BaseCommand):
+    help = ('Удаляет картинки рецептов и их уменьшенные копии, '
+            'на которые не ссылается ни один рецепт.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только показать файлы, которые будут удалены.')
+        parser.add_argument(
+            '--min-age', type=int, default=3600,
+            help='Не трогать файлы моложе указанного числа секунд.')
+
+    def is_old(self, storage, name, min_age):
+        modified = storage.get_modified_time(name)
+        return (timezone.now() - modified).total_seconds() >= min_age
+
+    def handle(self, *args, **options):
+        referenced = set(
+            Recipe.objects.exclude(image='').values_list('image', flat=True))
+        referenced_stems = {
+            os.path.splitext(posixpath.basename(name))[0]
+            for name in referenced
+        }
+        garbage = []
+        for name in walk(recipe_image_storage, IMAGES_DIR):
+            if name.startswith(DERIVATIVES_DIR + '/'):
+                stem = posixpath.relpath(name, DERIVATIVES_DIR).split('/')[0]
+                storage = default_storage
+                is_referenced = stem in referenced_stems
+            else:
+                storage = recipe_image_storage
+                is_referenced = name in referenced
+            if not is_referenced and self.is_old(
+                    storage, name, options['min_age']):
+                garbage.append((storage, name))
+        for storage, name in garbage:
+            self.stdout.write(name)
+            if not options['dry_run']:
+                storage.delete(name)
+        action = 'К удалению' if options['dry_run'] else 'Удалено'
+        self.stdout.write(f'{action} файлов: {len(garbage)}')
@@ -0,0 +1,248 @@
+import io
+import itertools
+import random
+import time
+from bisect import bisect
+from itertools import accumulate
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from PIL import Image
+from recipes.bulk import assign_ids
+from recipes.counters import get_counters, reconcile_counter
+from recipes.feed import rebuild_timelines
+from recipes.models import (Cart, Favorite, Ingredient, Recipe,
+                            RecipeIngredient, Tag)
+from recipes.search import update_search_index
+from recipes.storage import recipe_image_storage
+
+from users.models import Subscribe, User  # isort: split
+
+DISHES = ('борщ', 'суп', 'салат', 'пирог', 'омлет', 'плов', 'рагу',
+          'каша', 'запеканка', 'блины', 'котлеты', 'паста', 'пюре')
+ADJECTIVES = ('домашний', 'быстрый', 'летний', 'пряный', 'сытный',
+              'бабушкин', 'постный', 'праздничный', 'лёгкий', 'острый')
+TAG_COLORS = ('#E26C2D', '#49B64E', '#8775D2', '#F2C94C', '#2D9CDB')
+
+
+def zipf_cum_weights(size, exponent):
+    """Накопленные веса распределения Ципфа для size элементов:
+    первый элемент самый популярный.
+    """
+    return list(accumulate(1 / rank ** exponent
+                           for rank in range(1, size + 1)))
+
+
+def split_total(total, cum_weights):
+    """Делит total между элементами пропорционально весам."""
+    scale = total / cum_weights[-1]
+    previous = 0
+    counts = []
+    for weight in cum_weights:
+        counts.append(round(weight * scale) - round(previous * scale))
+        previous = weight
+    return counts
+
+
+class SkewedSampler:
+    """Выборка без повторов из values с весами Ципфа."""
+
+    def __init__(self, values, exponent, rng):
+        self.values = values
+        self.exponent = exponent
+        self.cum_weights = zipf_cum_weights(len(values), exponent)
+        self.total = self.cum_weights[-1]
+        self.rng = rng
+
+    def choice(self):
+        return self.values[bisect(self.cum_weights,
+                                  self.rng.random() * self.total)]
+
+    def sample(self, count, exclude=None):
+        count = min(count, len(self.values) - (exclude is not None))
+        chosen = set()
+        attempts = count * 4
+        while len(chosen) < count and attempts:
+            value = self.choice()
+            if value != exclude:
+                chosen.add(value)
+            attempts -= 1
+        return chosen
+
+
+class Command(BaseCommand):
+    help = ('Создаёт синтетических пользователей, рецепты, теги, '
+            'избранное, корзины и подписки для нагрузочного тестирования. '
+            'Популярность рецептов, авторов и ингредиентов подчиняется '
+            'закону Ципфа, данные детерминированы значением --seed. '
+            'Ингредиенты берутся из таблицы Ingredient (см. import_data). '
+            'Запись идёт пакетами bulk_create без сигналов; в конце '
+            'пересчитываются счётчики, поисковый индекс, списки покупок '
+            'и ленты подписок.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--recipes', type=int, default=10000)
+        parser.add_argument('--tags', type=int, default=5,
+                            help='Сколько тегов должно существовать.')
+        parser.add_argument('--favorites', type=int, default=50000)
+        parser.add_argument('--carts', type=int, default=10000)
+        parser.add_argument('--subscriptions', type=int, default=10000)
+        parser.add_argument('--min-ingredients', type=int, default=3)
+        parser.add_argument('--max-ingredients', type=int, default=15)
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Показатель распределения Ципфа.')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--skip-index', action='store_true',
+                            help='Не пересобирать поисковый индекс.')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.prefix = f'fake{options["seed"]}_'
+        ingredient_ids = list(Ingredient.objects.order_by('pk').values_list(
+            'pk', flat=True))
+        if not ingredient_ids:
+            raise CommandError('Таблица ингредиентов пуста, '
+                               'сначала выполните import_data')
+        if options['recipes'] and not options['users']:
+            raise CommandError('Для рецептов нужны пользователи-авторы')
+        if User.objects.filter(username__startswith=self.prefix).exists():
+            raise CommandError(f'Данные для --seed {options["seed"]} '
+                               f'уже созданы, укажите другой --seed')
+        self.rng.shuffle(ingredient_ids)
+        self.started = time.monotonic()
+        tag_ids = self.create_tags(options['tags'])
+        user_ids = self.create_users(options['users'])
+        recipe_ids = self.create_recipes(
+            options, user_ids, tag_ids, ingredient_ids)
+        self.create_links(options, user_ids, recipe_ids)
+        self.finish(options)
+
+    def report(self, message):
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(f'[{elapsed:7.1f} с] {message}')
+
+    def write(self, model, objs, ids=None):
+        """Пишет объекты пакетами и возвращает их число; первичные ключи
+        добавляются в список ids, если он передан.
+        """
+        written = 0
+        objs = iter(objs)
+        while True:
+            batch = list(itertools.islice(objs, self.batch_size))
+            if not batch:
+                return written
+            with transaction.atomic():
+                assign_ids(batch)
+                model.objects.bulk_create(batch)
+            written += len(batch)
+            if ids is not None:
+                ids.extend(obj.pk for obj in batch)
+
+    def create_tags(self, count):
+        existing = Tag.objects.count()
+        self.write(Tag, (
+            Tag(name=f'{self.prefix}тег {i}',
+                color=TAG_COLORS[i % len(TAG_COLORS)],
+                slug=f'{self.prefix}tag{i}')
+            for i in range(existing, count)))
+        return list(Tag.objects.values_list('pk', flat=True))
+
+    def create_users(self, count):
+        user_ids = []
+        self.write(User, (
+            User(username=f'{self.prefix}{i}',
+                 email=f'{self.prefix}{i}@example.com',
+                 first_name='Имя', last_name='Фамилия', password='!')
+            for i in range(count)), user_ids)
+        self.report(f'Пользователей: {len(user_ids)}')
+        return user_ids
+
+    def get_image_name(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 48), (226, 108, 45)).save(buffer, 'PNG')
+        return recipe_image_storage.save(
+            'recipes/fake.png', ContentFile(buffer.getvalue()))
+
+    def build_recipe(self, index, authors, image):
+        return Recipe(
+            author_id=authors.choice(),
+            name=(f'{self.rng.choice(ADJECTIVES)} '
+                  f'{self.rng.choice(DISHES)} {index}'),
+            text=' '.join(self.rng.choices(DISHES + ADJECTIVES, k=20)),
+            image=image,
+            cooking_time=self.rng.randint(5, 180),
+        )
+
+    def create_recipes(self, options, user_ids, tag_ids, ingredient_ids):
+        authors = SkewedSampler(user_ids, options['skew'], self.rng)
+        ingredients = SkewedSampler(ingredient_ids, options['skew'],
+                                    self.rng)
+        image = self.get_image_name()
+        recipe_ids = []
+        self.write(Recipe, (
+            self.build_recipe(index, authors, image)
+            for index in range(options['recipes'])), recipe_ids)
+        self.report(f'Рецептов: {len(recipe_ids)}')
+        amounts = self.write(RecipeIngredient, (
+            RecipeIngredient(recipe_id=recipe_id, ingredient_id=pk,
+                             amount=self.rng.randint(1, 100) * 5)
+            for recipe_id in recipe_ids
+            for pk in ingredients.sample(self.rng.randint(
+                options['min_ingredients'], options['max_ingredients']))))
+        self.report(f'Ингредиентов в рецептах: {amounts}')
+        self.write(Recipe.tags.through, (
+            Recipe.tags.through(recipe_id=recipe_id, tag_id=tag_id)
+            for recipe_id in recipe_ids
+            for tag_id in self.rng.sample(
+                tag_ids, min(len(tag_ids), self.rng.randint(1, 3)))))
+        return recipe_ids
+
+    def create_user_links(self, model, field, total, user_ids, sampler):
+        """Создаёт около total связей model(user, field).
+
+        Популярность объектов скошена с показателем sampler.exponent,
+        активность пользователей - с вдвое меньшим, чтобы самым
+        активным хватало объектов.
+        """
+        user_weights = zipf_cum_weights(len(user_ids),
+                                        sampler.exponent / 2)
+        counts = split_total(total, user_weights)
+        rows = self.write(model, (
+            model(user_id=user_id, **{f'{field}_id': pk})
+            for user_id, count in zip(user_ids, counts)
+            for pk in sampler.sample(
+                count, exclude=user_id if field == 'author' else None)))
+        self.report(f'{model._meta.verbose_name_plural}: {rows}')
+
+    def create_links(self, options, user_ids, recipe_ids):
+        if not user_ids:
+            return
+        users = list(user_ids)
+        self.rng.shuffle(users)
+        recipes = SkewedSampler(recipe_ids, options['skew'], self.rng)
+        if recipe_ids:
+            self.create_user_links(Favorite, 'recipe', options['favorites'],
+                                   users, recipes)
+            self.create_user_links(Cart, 'recipe', options['carts'],
+                                   users, recipes)
+        authors = SkewedSampler(user_ids, options['skew'], self.rng)
+        self.create_user_links(Subscribe, 'author', options['subscriptions'],
+                               users, authors)
+
+    def finish(self, options):
+        with transaction.atomic():
+            for counter in get_counters():
+                reconcile_counter(*counter)
+        self.report('Счётчики пересчитаны')
+        if not options['skip_index']:
+            update_search_index()
+            self.report('Поисковый индекс пересобран')
+        call_command('rebuild_shopping_lists', stdout=io.StringIO())
+        self.report('Списки покупок пересобраны')
+        rebuild_timelines()
+        self.report('Ленты подписок пересобраны')
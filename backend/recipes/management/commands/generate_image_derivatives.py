@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from recipes.images import generate_derivatives
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = 'Создаёт уменьшенные копии картинок существующих рецептов.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Обработать и рецепты с уже готовыми копиями.')
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.exclude(image='').values_list(
+            'pk', 'image', 'image_derivatives')
+        processed = 0
+        for pk, image, derivatives in recipes.iterator():
+            if (not options['force'] and derivatives
+                    and derivatives.get('source') == image):
+                continue
+            try:
+                generate_derivatives(pk)
+            except OSError as exc:
+                self.stderr.write(f'Рецепт {pk}: {exc}')
+                continue
+            processed += 1
+        self.stdout.write(f'Обработано рецептов: {processed}')
@@ -1,16 +1,102 @@
 import csv
+import io
+import sys
+from itertools import islice
 
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
 from recipes.models import Ingredient
 
+STAGING_TABLE = 'recipes_ingredient_staging'
+
 
 class Command(BaseCommand):
-    def handle(self, *args, **kwargs):
-        with open('data/ingredients.csv') as f:
-            reader = csv.reader(f)
+    help = ('Загружает ингредиенты из CSV (название, единица измерения). '
+            'Повторная загрузка не создаёт дубликатов.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default='data/ingredients.csv',
+            help='Путь к CSV-файлу или - для stdin.')
+        parser.add_argument('--skip-header', action='store_true',
+                            help='Пропустить первую строку файла.')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только показать, какие ингредиенты будут добавлены.')
+
+    def read_chunks(self, stream, skip_header, chunk_size):
+        reader = csv.reader(stream)
+        if skip_header:
             next(reader, None)
-            ingredient_list = [
-                Ingredient(
-                    name=row[0],
-                    measurement_unit=row[1]) for row in reader]
-            Ingredient.objects.bulk_create(ingredient_list)
+        rows = (
+            (row[0].strip(), row[1].strip())
+            for row in reader if len(row) >= 2 and row[0].strip()
+        )
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def load_postgresql(self, chunks):
+        table = Ingredient._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMP TABLE {STAGING_TABLE} '
+                f'(name varchar(200), measurement_unit varchar(200)) '
+                f'ON COMMIT DROP')
+            for chunk in chunks:
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(chunk)
+                buffer.seek(0)
+                cursor.cursor.copy_expert(
+                    f'COPY {STAGING_TABLE} (name, measurement_unit) '
+                    f'FROM STDIN WITH (FORMAT csv)', buffer)
+            cursor.execute(
+                f'INSERT INTO {table} (name, measurement_unit) '
+                f'SELECT DISTINCT name, measurement_unit FROM {STAGING_TABLE} '
+                f'ON CONFLICT (name, measurement_unit) DO NOTHING')
+            return cursor.rowcount
+
+    def load_batched(self, chunks):
+        before = Ingredient.objects.count()
+        for chunk in chunks:
+            Ingredient.objects.bulk_create(
+                (Ingredient(name=name, measurement_unit=unit)
+                 for name, unit in dict.fromkeys(chunk)),
+                ignore_conflicts=True)
+        return Ingredient.objects.count() - before
+
+    def diff(self, chunks):
+        existing = set(Ingredient.objects.values_list(
+            'name', 'measurement_unit'))
+        names = {name for name, _ in existing}
+        new = {}
+        for chunk in chunks:
+            new.update(dict.fromkeys(
+                row for row in chunk if row not in existing))
+        for name, unit in new:
+            note = ' (новая единица измерения)' if name in names else ''
+            self.stdout.write(f'+ {name}, {unit}{note}')
+        self.stdout.write(f'Будет добавлено ингредиентов: {len(new)}')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        stream = (sys.stdin if path == '-'
+                  else open(path, encoding='utf-8', newline=''))
+        try:
+            chunks = self.read_chunks(stream, options['skip_header'],
+                                      options['chunk_size'])
+            if options['dry_run']:
+                self.diff(chunks)
+                return
+            with transaction.atomic():
+                if connection.vendor == 'postgresql':
+                    created = self.load_postgresql(chunks)
+                else:
+                    created = self.load_batched(chunks)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        self.stdout.write(f'Добавлено ингредиентов: {created}')
@@ -0,0 +1,218 @@
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from recipes.bulk import assign_ids
+from recipes.counters import change_counter
+from recipes.feed import fan_out
+from recipes.models import Ingredient, Recipe, RecipeIngredient, Tag
+from recipes.search import update_search_index
+from recipes.storage import recipe_image_storage
+
+from users.models import User  # isort: split
+
+FORMATS = ('ndjson', 'csv')
+
+
+class RowError(ValueError):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Загружает рецепты из NDJSON или CSV пакетами через bulk_create. '
+        'Каждая запись: author (username или email), name, text, '
+        'cooking_time, image (путь в MEDIA_ROOT или к локальному файлу), '
+        'tags (список slug) и ingredients (список объектов с id или name, '
+        'необязательным measurement_unit и amount). В CSV столбцы tags '
+        'и ingredients содержат JSON. Уменьшенные копии картинок '
+        'создаются отдельно командой generate_image_derivatives.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к файлу или - для stdin.')
+        parser.add_argument('--format', choices=FORMATS,
+                            help='Формат файла; по умолчанию по расширению.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def get_format(self, path, file_format):
+        if file_format:
+            return file_format
+        if path.endswith('.csv'):
+            return 'csv'
+        if path == '-' or path.endswith(('.ndjson', '.jsonl')):
+            return 'ndjson'
+        raise CommandError('Не удалось определить формат, укажите --format')
+
+    def read_rows(self, stream, file_format):
+        if file_format == 'csv':
+            for line_number, row in enumerate(csv.DictReader(stream), 2):
+                try:
+                    row['tags'] = json.loads(row.get('tags') or '[]')
+                    row['ingredients'] = json.loads(
+                        row.get('ingredients') or '[]')
+                except json.JSONDecodeError as exc:
+                    yield line_number, RowError(f'неверный JSON: {exc}')
+                    continue
+                yield line_number, row
+            return
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except json.JSONDecodeError as exc:
+                yield line_number, RowError(f'неверный JSON: {exc}')
+
+    def load_maps(self):
+        self.users = {}
+        for pk, username, email in User.objects.values_list(
+                'pk', 'username', 'email').iterator():
+            self.users[username] = pk
+            self.users.setdefault(email, pk)
+        self.tags = dict(Tag.objects.values_list('slug', 'pk'))
+        self.ingredient_ids = set()
+        self.ingredients = {}
+        self.ingredient_names = {}
+        for pk, name, unit in Ingredient.objects.values_list(
+                'pk', 'name', 'measurement_unit').iterator():
+            self.ingredient_ids.add(pk)
+            self.ingredients[(name, unit)] = pk
+            self.ingredient_names.setdefault(name, []).append(pk)
+
+    def resolve_ingredient(self, item):
+        if 'id' in item:
+            if item['id'] not in self.ingredient_ids:
+                raise RowError(f'нет ингредиента с id {item["id"]}')
+            return item['id']
+        name = item.get('name')
+        if 'measurement_unit' in item:
+            pk = self.ingredients.get((name, item['measurement_unit']))
+            if pk is None:
+                raise RowError(f'нет ингредиента {name} '
+                               f'({item["measurement_unit"]})')
+            return pk
+        candidates = self.ingredient_names.get(name, [])
+        if len(candidates) != 1:
+            raise RowError(f'ингредиент {name} не найден или неоднозначен, '
+                           f'укажите measurement_unit')
+        return candidates[0]
+
+    def store_image(self, image):
+        if not image or not os.path.isabs(image):
+            return image or ''
+        with open(image, 'rb') as f:
+            return recipe_image_storage.save(
+                f'recipes/{os.path.basename(image)}', File(f))
+
+    def build_tag_ids(self, row):
+        tag_ids = set()
+        for slug in row.get('tags', []):
+            if slug not in self.tags:
+                raise RowError(f'нет тега {slug}')
+            tag_ids.add(self.tags[slug])
+        return tag_ids
+
+    def build_amounts(self, row):
+        amounts = {}
+        for item in row.get('ingredients', []):
+            pk = self.resolve_ingredient(item)
+            if pk in amounts:
+                raise RowError('ингредиенты в рецепте должны быть уникальными')
+            try:
+                amounts[pk] = int(item['amount'])
+            except (KeyError, TypeError, ValueError):
+                raise RowError('amount должно быть числом')
+            if amounts[pk] < 1:
+                raise RowError('amount должно быть больше 0')
+        return amounts
+
+    def build(self, row):
+        """Рецепт, его ингредиенты и id тегов из записи файла."""
+        if isinstance(row, RowError):
+            raise row
+        author_id = self.users.get(row.get('author'))
+        if author_id is None:
+            raise RowError(f'нет пользователя {row.get("author")}')
+        try:
+            cooking_time = int(row['cooking_time'])
+        except (KeyError, TypeError, ValueError):
+            raise RowError('cooking_time должно быть числом')
+        if cooking_time < 1 or not row.get('name'):
+            raise RowError('нужны name и cooking_time больше 0')
+        tag_ids = self.build_tag_ids(row)
+        amounts = self.build_amounts(row)
+        recipe = Recipe(
+            author_id=author_id,
+            name=row['name'],
+            text=row.get('text', ''),
+            cooking_time=cooking_time,
+            image=self.store_image(row.get('image')),
+        )
+        return recipe, amounts, tag_ids
+
+    @transaction.atomic
+    def write_batch(self, batch):
+        recipes = [recipe for recipe, _, _ in batch]
+        assign_ids(recipes)
+        Recipe.objects.bulk_create(recipes)
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(recipe_id=recipe.pk, ingredient_id=pk,
+                             amount=amount)
+            for recipe, amounts, _ in batch
+            for pk, amount in amounts.items()
+        )
+        Recipe.tags.through.objects.bulk_create(
+            Recipe.tags.through(recipe_id=recipe.pk, tag_id=tag_id)
+            for recipe, _, tag_ids in batch
+            for tag_id in tag_ids
+        )
+        change_counter(
+            User, 'recipes_count',
+            Counter(recipe.author_id for recipe in recipes))
+        update_search_index([recipe.pk for recipe in recipes])
+        fan_out([recipe.pk for recipe in recipes])
+
+    def flush(self, batch, loaded, started):
+        self.write_batch(batch)
+        loaded += len(batch)
+        elapsed = time.monotonic() - started
+        self.stdout.write(f'Загружено {loaded} рецептов, '
+                          f'{loaded / elapsed:.0f} в секунду')
+        return len(batch)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = self.get_format(path, options['format'])
+        self.load_maps()
+        stream = (sys.stdin if path == '-'
+                  else open(path, encoding='utf-8', newline=''))
+        started = time.monotonic()
+        loaded = skipped = 0
+        batch = []
+        try:
+            for line_number, row in self.read_rows(stream, file_format):
+                try:
+                    batch.append(self.build(row))
+                except (RowError, OSError) as exc:
+                    skipped += 1
+                    self.stderr.write(f'Строка {line_number}: {exc}')
+                    continue
+                if len(batch) >= options['batch_size']:
+                    loaded += self.flush(batch, loaded, started)
+                    batch = []
+            if batch:
+                loaded += self.flush(batch, loaded, started)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f'Готово: загружено {loaded}, пропущено {skipped} '
+            f'за {elapsed:.1f} с')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from recipes.pantry import pantry_index
+
+
+class Command(BaseCommand):
+    help = ('Строит инвертированный индекс ингредиентов для подбора '
+            'рецептов по продуктам и сохраняет его в PANTRY_INDEX_PATH. '
+            'Запускается после деплоя и периодически, чтобы вычистить '
+            'удалённые рецепты; процессы подхватывают новый файл сами.')
+
+    def handle(self, *args, **kwargs):
+        count = pantry_index.build()
+        self.stdout.write(f'Рецептов в индексе: {count}')
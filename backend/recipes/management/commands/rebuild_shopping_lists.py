@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+from recipes.models import RecipeIngredient, ShoppingListItem
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = ('Пересобирает списки покупок из корзин пользователей '
+            'или, с --verify, сверяет их.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Только сверить списки покупок с корзинами.')
+
+    def get_expected(self):
+        totals = RecipeIngredient.objects.filter(
+            recipe__cart__isnull=False).values_list(
+                'recipe__cart__user', 'ingredient').order_by().annotate(
+                    total=Sum('amount'))
+        return {(user_id, ingredient_id): total
+                for user_id, ingredient_id, total in totals.iterator()}
+
+    def handle(self, *args, **options):
+        expected = self.get_expected()
+        if options['verify']:
+            actual = {
+                (user_id, ingredient_id): amount
+                for user_id, ingredient_id, amount in
+                ShoppingListItem.objects.values_list(
+                    'user_id', 'ingredient_id', 'amount').iterator()
+            }
+            mismatched = {
+                key for key in expected.keys() | actual.keys()
+                if expected.get(key) != actual.get(key)
+            }
+            for user_id, ingredient_id in sorted(mismatched):
+                self.stdout.write(
+                    f'user={user_id} ingredient={ingredient_id}: '
+                    f'expected {expected.get((user_id, ingredient_id))}, '
+                    f'actual {actual.get((user_id, ingredient_id))}')
+            if mismatched:
+                raise CommandError(
+                    f'Расхождений в списках покупок: {len(mismatched)}')
+            self.stdout.write('Списки покупок совпадают с корзинами')
+            return
+        with transaction.atomic():
+            ShoppingListItem.objects.all().delete()
+            ShoppingListItem.objects.bulk_create(
+                (ShoppingListItem(user_id=user_id,
+                                  ingredient_id=ingredient_id,
+                                  amount=total)
+                 for (user_id, ingredient_id), total in expected.items()),
+                batch_size=BATCH_SIZE)
+        self.stdout.write(f'Записано строк: {len(expected)}')
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from recipes.similar import similar_recipes_index
+
+
+class Command(BaseCommand):
+    help = ('Строит индекс похожих рецептов по всем рецептам и сохраняет '
+            'его в SIMILAR_RECIPES_INDEX_PATH.')
+
+    def handle(self, *args, **kwargs):
+        count = similar_recipes_index.build()
+        self.stdout.write(f'Рецептов в индексе: {count}')
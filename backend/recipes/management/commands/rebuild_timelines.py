@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from recipes.feed import rebuild_timelines
+
+
+class Command(BaseCommand):
+    help = ('Пересобирает ленты рецептов всех пользователей из подписок. '
+            'Нужна после массовой загрузки рецептов или подписок и после '
+            'изменения FEED_TIMELINE_LENGTH или FEED_CELEBRITY_FOLLOWERS.')
+
+    def handle(self, *args, **kwargs):
+        count = rebuild_timelines()
+        self.stdout.write(f'Записей в лентах: {count}')
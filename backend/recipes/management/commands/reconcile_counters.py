@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from recipes.counters import get_counters, reconcile_counter
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает счётчики избранного, корзин, рецептов '
+            'и подписчиков и исправляет расхождения.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только показать число расхождений.')
+
+    def handle(self, *args, **options):
+        total = 0
+        with transaction.atomic():
+            for model, field, related_model, related_field in get_counters():
+                count = reconcile_counter(
+                    model, field, related_model, related_field,
+                    dry_run=options['dry_run'])
+                total += count
+                self.stdout.write(
+                    f'{model._meta.label}.{field}: расхождений {count}')
+        if options['dry_run']:
+            self.stdout.write(f'Найдено расхождений: {total}')
+        else:
+            self.stdout.write(f'Исправлено расхождений: {total}')
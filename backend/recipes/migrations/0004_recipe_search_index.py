@@ -0,0 +1,73 @@
+from django.db import migrations
+
+POSTGRES_FORWARD = [
+    'ALTER TABLE recipes_recipe ADD COLUMN search_vector tsvector',
+    'CREATE INDEX recipes_recipe_search_vector_idx '
+    'ON recipes_recipe USING GIN (search_vector)',
+]
+POSTGRES_BACKWARD = [
+    'ALTER TABLE recipes_recipe DROP COLUMN search_vector',
+]
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE recipes_recipe_fts USING fts5("
+    "name, ingredients, text, tokenize = 'unicode61')",
+]
+SQLITE_BACKWARD = [
+    'DROP TABLE recipes_recipe_fts',
+]
+
+# Заполнение поискового индекса на момент создания миграции
+POSTGRES_FILL_SQL = """
+UPDATE recipes_recipe r SET search_vector =
+    setweight(to_tsvector('russian', translate(r.name, 'ёЁ', 'еЕ')), 'A')
+    || setweight(to_tsvector('russian', translate(coalesce((
+        SELECT string_agg(i.name, ' ')
+        FROM recipes_recipeingredient ri
+        JOIN recipes_ingredient i ON i.id = ri.ingredient_id
+        WHERE ri.recipe_id = r.id), ''), 'ёЁ', 'еЕ')), 'B')
+    || setweight(to_tsvector('russian', translate(r.text, 'ёЁ', 'еЕ')), 'C')
+"""
+SQLITE_FILL_SQL = """
+INSERT INTO recipes_recipe_fts (rowid, name, ingredients, text)
+SELECT r.id,
+       replace(replace(r.name, 'ё', 'е'), 'Ё', 'Е'),
+       replace(replace(coalesce((
+           SELECT group_concat(i.name, ' ')
+           FROM recipes_recipeingredient ri
+           JOIN recipes_ingredient i ON i.id = ri.ingredient_id
+           WHERE ri.recipe_id = r.id), ''), 'ё', 'е'), 'Ё', 'Е'),
+       replace(replace(r.text, 'ё', 'е'), 'Ё', 'Е')
+FROM recipes_recipe r
+"""
+
+
+def execute(schema_editor, statements):
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        execute(schema_editor, POSTGRES_FORWARD + [POSTGRES_FILL_SQL])
+    elif vendor == 'sqlite':
+        execute(schema_editor, SQLITE_FORWARD + [SQLITE_FILL_SQL])
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        execute(schema_editor, POSTGRES_BACKWARD)
+    elif vendor == 'sqlite':
+        execute(schema_editor, SQLITE_BACKWARD)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_alter_favorite_recipe'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
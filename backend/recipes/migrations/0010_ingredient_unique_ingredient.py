@@ -0,0 +1,48 @@
+from django.db import migrations, models
+from django.db.models import Count, F, Min
+
+
+def merge_duplicate_ingredients(apps, schema_editor):
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    RecipeIngredient = apps.get_model('recipes', 'RecipeIngredient')
+    ShoppingListItem = apps.get_model('recipes', 'ShoppingListItem')
+    duplicates = Ingredient.objects.values(
+        'name', 'measurement_unit').order_by().annotate(
+            keep=Min('id'), total=Count('id')).filter(total__gt=1)
+    for row in duplicates:
+        keep = row['keep']
+        duplicate_ids = list(Ingredient.objects.filter(
+            name=row['name'], measurement_unit=row['measurement_unit'],
+        ).exclude(pk=keep).values_list('pk', flat=True))
+        for duplicate_id in duplicate_ids:
+            for model, owner in ((RecipeIngredient, 'recipe'),
+                                 (ShoppingListItem, 'user')):
+                owners_with_keep = list(model.objects.filter(
+                    ingredient_id=keep).values_list(owner, flat=True))
+                merged = model.objects.filter(
+                    ingredient_id=duplicate_id,
+                    **{f'{owner}__in': owners_with_keep})
+                for owner_id, amount in merged.values_list(owner, 'amount'):
+                    model.objects.filter(
+                        ingredient_id=keep, **{owner: owner_id}).update(
+                            amount=F('amount') + amount)
+                merged.delete()
+                model.objects.filter(ingredient_id=duplicate_id).update(
+                    ingredient_id=keep)
+        Ingredient.objects.filter(pk__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_alter_recipe_image'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_ingredients,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='ingredient',
+            constraint=models.UniqueConstraint(fields=('name', 'measurement_unit'), name='unique_ingredient'),
+        ),
+    ]
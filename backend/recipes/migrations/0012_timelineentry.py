@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Значения FEED_TIMELINE_LENGTH и FEED_CELEBRITY_FOLLOWERS на момент
+# создания миграции
+TIMELINE_LENGTH = 500
+CELEBRITY_FOLLOWERS = 10000
+
+FILL_SQL = """
+INSERT INTO {timeline} (user_id, recipe_id, pub_date)
+SELECT user_id, recipe_id, pub_date FROM (
+    SELECT s.user_id, r.id AS recipe_id, r.pub_date,
+           ROW_NUMBER() OVER (
+               PARTITION BY s.user_id
+               ORDER BY r.pub_date DESC, r.id DESC) AS row_number
+    FROM {subscribe} s
+    JOIN {user} u ON u.id = s.author_id
+    JOIN {recipe} r ON r.author_id = s.author_id
+    WHERE u.followers_count < %s
+) ranked
+WHERE row_number <= %s
+"""
+
+
+def fill_timelines(apps, schema_editor):
+    tables = {
+        name: apps.get_model(*label.split('.'))._meta.db_table
+        for name, label in (('timeline', 'recipes.TimelineEntry'),
+                            ('subscribe', 'users.Subscribe'),
+                            ('user', settings.AUTH_USER_MODEL),
+                            ('recipe', 'recipes.Recipe'))
+    }
+    schema_editor.execute(FILL_SQL.format(**tables),
+                          (CELEBRITY_FOLLOWERS, TIMELINE_LENGTH))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0011_recipe_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pub_date', models.DateTimeField(verbose_name='date of publication')),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='recipes.recipe', verbose_name='recipe')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'timeline entry',
+                'verbose_name_plural': 'timeline entries',
+                'ordering': ['-pub_date', '-recipe'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='timelineentry',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_timeline_entry'),
+        ),
+        migrations.AddIndex(
+            model_name='timelineentry',
+            index=models.Index(fields=['user', '-pub_date'], name='timeline_user_pub_date_idx'),
+        ),
+        migrations.RunPython(fill_timelines, migrations.RunPython.noop),
+    ]
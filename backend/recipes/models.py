@@ -1,8 +1,13 @@
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import (Case, Count, Exists, F, Max, OuterRef, Prefetch,
+                              Subquery, Sum, Value, When, Window)
+from django.db.models.functions import RowNumber
 from django.utils.translation import gettext_lazy as _
 # isort: skip
-from users.models import User
+from users.models import Subscribe, User
+
+from .storage import recipe_image_storage
 
 COLOR_PALETTE = [
     ('#E26C2D', 'orange', ),
@@ -29,6 +34,10 @@ class Tag(models.Model):
         null=True,
         unique=True,
     )
+    updated_at = models.DateTimeField(
+        verbose_name=_('date of update'),
+        auto_now=True,
+    )
 
     class Meta:
         verbose_name = _('tag')
@@ -49,16 +58,106 @@ class Ingredient(models.Model):
         verbose_name=_('unit of measurement'),
         max_length=200,
     )
+    updated_at = models.DateTimeField(
+        verbose_name=_('date of update'),
+        auto_now=True,
+    )
 
     class Meta:
         verbose_name = _('ingredient')
         verbose_name_plural = _('ingredients')
         ordering = ['name']
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'measurement_unit'],
+                                    name='unique_ingredient'),
+        ]
 
     def __str__(self):
         return self.name
 
 
+def recipe_related_lookups():
+    """Lookups для предзагрузки тегов и ингредиентов рецепта."""
+    return (
+        'tags',
+        Prefetch('recipeingredient',
+                 queryset=RecipeIngredient.objects.select_related(
+                     'ingredient')),
+    )
+
+
+class RecipeQuerySet(models.QuerySet):
+
+    def with_related(self):
+        """Загружает автора, теги и ингредиенты рецептов
+        фиксированным числом запросов.
+        """
+        return self.select_related('author').prefetch_related(
+            *recipe_related_lookups())
+
+    def latest_for_authors(self, author_ids, limit):
+        """Не больше limit последних рецептов каждого из авторов
+        одним запросом с ROW_NUMBER() OVER (PARTITION BY author).
+        """
+        if not author_ids:
+            return []
+        ranked = self.filter(author_id__in=author_ids).order_by().annotate(
+            row_number=Window(
+                expression=RowNumber(),
+                partition_by=F('author_id'),
+                order_by=(F('pub_date').desc(), F('id').desc()),
+            )
+        ).values('id', 'author_id', 'name', 'image', 'image_derivatives',
+                 'cooking_time', 'row_number')
+        sql, params = ranked.query.sql_with_params()
+        return self.raw(
+            f'SELECT * FROM ({sql}) ranked WHERE row_number <= %s '
+            f'ORDER BY author_id, row_number',
+            (*params, limit),
+        )
+
+    def with_versions(self):
+        """Аннотирует рецепты временем последнего изменения и числом
+        их тегов и ингредиентов: от них зависит представление рецепта,
+        а изменение справочников не меняет updated_at рецепта.
+        """
+        tags = self.model.tags.through.objects.filter(
+            recipe=OuterRef('pk')).order_by().values('recipe')
+        ingredients = RecipeIngredient.objects.filter(
+            recipe=OuterRef('pk')).order_by().values('recipe')
+        return self.annotate(
+            tags_updated_at=Subquery(tags.annotate(
+                latest=Max('tag__updated_at')).values('latest')),
+            tags_count=Subquery(tags.annotate(
+                count=Count('pk')).values('count')),
+            ingredients_updated_at=Subquery(ingredients.annotate(
+                latest=Max('ingredient__updated_at')).values('latest')),
+            ingredients_count=Subquery(ingredients.annotate(
+                count=Count('pk')).values('count')),
+        )
+
+    def with_user_flags(self, user):
+        """Аннотирует рецепты флагами is_favorited, is_in_shopping_cart
+        и is_author_subscribed для пользователя user.
+        """
+        if user.is_anonymous:
+            return self.annotate(
+                is_favorited=Value(False, output_field=models.BooleanField()),
+                is_in_shopping_cart=Value(
+                    False, output_field=models.BooleanField()),
+                is_author_subscribed=Value(
+                    False, output_field=models.BooleanField()),
+            )
+        return self.annotate(
+            is_favorited=Exists(Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_in_shopping_cart=Exists(Cart.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_author_subscribed=Exists(Subscribe.objects.filter(
+                user=user, author=OuterRef('author'))),
+        )
+
+
 class Recipe(models.Model):
     author = models.ForeignKey(
         User,
@@ -73,6 +172,13 @@ class Recipe(models.Model):
     image = models.ImageField(
         verbose_name=_('image'),
         upload_to='recipes/',
+        storage=recipe_image_storage,
+    )
+    image_derivatives = models.JSONField(
+        verbose_name=_('image derivatives'),
+        default=dict,
+        blank=True,
+        editable=False,
     )
     text = models.TextField(
         verbose_name=_('text'),
@@ -94,11 +200,33 @@ class Recipe(models.Model):
         verbose_name=_('date of publication'),
         auto_now_add=True,
     )
+    updated_at = models.DateTimeField(
+        verbose_name=_('date of update'),
+        auto_now=True,
+    )
+    favorites_count = models.IntegerField(
+        verbose_name=_('favorites count'),
+        default=0,
+        editable=False,
+    )
+    carts_count = models.IntegerField(
+        verbose_name=_('shopping carts count'),
+        default=0,
+        editable=False,
+    )
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         verbose_name = _('recipe')
         verbose_name_plural = _('recipes')
         ordering = ['-pub_date']
+        indexes = [
+            models.Index(fields=['-pub_date', '-id'],
+                         name='recipe_pub_date_id_idx'),
+            models.Index(fields=['updated_at'],
+                         name='recipe_updated_at_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -180,3 +308,186 @@ class Cart(models.Model):
 
     def __str__(self):
         return f'{self.recipe} in shopping cart {self.user}'
+
+
+class ShoppingListItemQuerySet(models.QuerySet):
+
+    def apply_amounts(self, user_ids, amounts):
+        """Прибавляет к спискам покупок пользователей user_ids
+        количества amounts вида {ingredient_id: amount}.
+
+        Отрицательные количества уменьшают итог, строки с нулевым
+        итогом удаляются.
+        """
+        amounts = {pk: amount for pk, amount in amounts.items() if amount}
+        user_ids = list(user_ids)
+        if not amounts or not user_ids:
+            return
+        with transaction.atomic():
+            # Блокировка пользователей не даёт параллельным запросам
+            # одновременно создать одну и ту же строку списка
+            lock_users(user_ids)
+            items = self.filter(user_id__in=user_ids,
+                                ingredient_id__in=amounts)
+            existing = set(items.select_for_update().values_list(
+                'user_id', 'ingredient_id'))
+            items.update(amount=F('amount') + Case(
+                *[When(ingredient_id=pk, then=Value(amount))
+                  for pk, amount in amounts.items()],
+                output_field=models.IntegerField(),
+            ))
+            self.bulk_create([
+                ShoppingListItem(user_id=user_id, ingredient_id=pk,
+                                 amount=amount)
+                for user_id in user_ids
+                for pk, amount in amounts.items()
+                if amount > 0 and (user_id, pk) not in existing
+            ])
+            items.filter(amount__lte=0).delete()
+
+    def add_recipe(self, user, recipe):
+        self.apply_amounts([user.pk], get_recipe_amounts(recipe))
+
+    def remove_recipe(self, user, recipe):
+        amounts = get_recipe_amounts(recipe)
+        self.apply_amounts(
+            [user.pk], {pk: -amount for pk, amount in amounts.items()})
+
+    def add_recipes(self, user, recipe_ids):
+        self.apply_amounts([user.pk], get_recipes_amounts(recipe_ids))
+
+    def remove_recipes(self, user, recipe_ids):
+        amounts = get_recipes_amounts(recipe_ids)
+        self.apply_amounts(
+            [user.pk], {pk: -amount for pk, amount in amounts.items()})
+
+    def remove_carts(self, carts):
+        """Вычитает рецепты из корзин carts из списков покупок их
+        владельцев; вызывается до удаления корзин.
+        """
+        amounts = {}
+        for user_id, pk, amount in RecipeIngredient.objects.filter(
+                recipe__cart__in=carts).order_by().values(
+                    'recipe__cart__user_id', 'ingredient_id').annotate(
+                        total=Sum('amount')).values_list(
+                            'recipe__cart__user_id', 'ingredient_id',
+                            'total'):
+            amounts.setdefault(user_id, {})[pk] = -amount
+        for user_id, user_amounts in amounts.items():
+            self.apply_amounts([user_id], user_amounts)
+
+    def update_recipe(self, recipe, old_amounts, amounts=None):
+        """Переносит изменение ингредиентов рецепта в списки покупок
+        пользователей, у которых рецепт лежит в корзине.
+
+        amounts - новые количества, если они уже известны.
+        """
+        amounts = dict(get_recipe_amounts(recipe) if amounts is None
+                       else amounts)
+        for pk, amount in old_amounts.items():
+            amounts[pk] = amounts.get(pk, 0) - amount
+        self.apply_amounts(
+            Cart.objects.filter(recipe=recipe).values_list(
+                'user_id', flat=True),
+            amounts)
+
+
+def lock_users(user_ids):
+    """Блокирует строки пользователей до конца транзакции.
+
+    Изменения избранного, корзин и списков покупок пользователя
+    выполняются под этой блокировкой, чтобы параллельные запросы
+    не добавили и не учли в счётчиках одну связь дважды.
+    """
+    list(User.objects.select_for_update().filter(
+        pk__in=user_ids).order_by('pk').values_list('pk'))
+
+
+def get_recipe_amounts(recipe):
+    """Количества ингредиентов рецепта вида {ingredient_id: amount}."""
+    return dict(RecipeIngredient.objects.filter(recipe=recipe).values_list(
+        'ingredient_id', 'amount'))
+
+
+def get_recipes_amounts(recipe_ids):
+    """Суммарные количества ингредиентов рецептов recipe_ids
+    вида {ingredient_id: amount}.
+    """
+    if not recipe_ids:
+        return {}
+    return dict(RecipeIngredient.objects.filter(
+        recipe_id__in=recipe_ids).order_by().values(
+            'ingredient_id').annotate(total=Sum('amount')).values_list(
+                'ingredient_id', 'total'))
+
+
+class ShoppingListItem(models.Model):
+    """Итог по ингредиенту в списке покупок пользователя.
+
+    Поддерживается при добавлении и удалении рецептов из корзины
+    и при изменении ингредиентов рецептов в корзине.
+    """
+
+    user = models.ForeignKey(
+        User,
+        verbose_name=_('user'),
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        verbose_name=_('ingredient'),
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    amount = models.IntegerField(
+        verbose_name=_('amount'),
+    )
+
+    objects = ShoppingListItemQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _('shopping list item')
+        verbose_name_plural = _('shopping list items')
+        ordering = ['-pk']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'ingredient'],
+                                    name='unique_shopping_list_item'),
+        ]
+
+    def __str__(self):
+        return f'{self.ingredient} in shopping list {self.user}'
+
+
+class TimelineEntry(models.Model):
+    user = models.ForeignKey(
+        User,
+        verbose_name=_('user'),
+        on_delete=models.CASCADE,
+        related_name='timeline',
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        verbose_name=_('recipe'),
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    pub_date = models.DateTimeField(
+        verbose_name=_('date of publication'),
+    )
+
+    class Meta:
+        verbose_name = _('timeline entry')
+        verbose_name_plural = _('timeline entries')
+        ordering = ['-pub_date', '-recipe']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'recipe'],
+                                    name='unique_timeline_entry'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-pub_date'],
+                         name='timeline_user_pub_date_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.recipe} in timeline {self.user}'
@@ -0,0 +1,283 @@
+"""Инвертированный индекс ингредиентов для подбора рецептов по продуктам.
+
+Для каждого ингредиента хранится отсортированный массив строк рецептов,
+в которые он входит, для каждого рецепта — число его ингредиентов.
+Покрытие рецептов набором продуктов считается одним np.bincount
+по объединению списков строк выбранных ингредиентов.
+
+Индекс строится командой rebuild_pantry_index и хранится в файле
+PANTRY_INDEX_PATH, процессы загружают его при первом обращении.
+Изменённые рецепты находятся по updated_at, их ингредиенты
+перечитываются из RecipeIngredient и дописываются в несортированный
+хвост, который сливается с основной частью, когда разрастается.
+Удалённые рецепты помечаются устаревшими, когда не находятся в БД
+при выдаче результата (remove), и вычищаются пересборкой индекса.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Recipe, RecipeIngredient
+from .utils import SYNC_OVERLAP, iter_chunks
+
+FORMAT_VERSION = 1
+READ_CHUNK_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+
+def read_ingredients(recipe_ids=None):
+    """Столбцы (recipe_ids, ingredient_ids, versions) связей рецептов
+    с ингредиентами, versions - updated_at рецепта в секундах.
+
+    Строки читаются порциями, чтобы не держать в памяти кортежи
+    всей таблицы.
+    """
+    rows = RecipeIngredient.objects.order_by()
+    if recipe_ids is not None:
+        rows = rows.filter(recipe_id__in=recipe_ids)
+    rows = rows.values_list(
+        'recipe_id', 'ingredient_id', 'recipe__updated_at').iterator(
+            chunk_size=READ_CHUNK_SIZE)
+    chunks = []
+    for chunk in iter_chunks(rows, READ_CHUNK_SIZE):
+        chunk_recipe_ids, ingredient_ids, versions = zip(*chunk)
+        chunks.append((
+            np.array(chunk_recipe_ids, dtype=np.int64),
+            np.array(ingredient_ids, dtype=np.int64),
+            np.array([version.timestamp() for version in versions],
+                     dtype=np.float64),
+        ))
+    if not chunks:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.float64))
+    return tuple(np.concatenate(parts) for parts in zip(*chunks))
+
+
+class PantryIndex:
+    """Инвертированный индекс ингредиентов в памяти процесса.
+
+    Строки массивов recipe_ids, versions, sizes и alive соответствуют
+    версиям рецептов. Основная часть индекса — пары
+    (posting_ingredients, posting_rows), отсортированные по ингредиенту
+    и строке; новые пары лежат в tail_ingredients/tail_rows.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._refreshed_at = 0
+        self._saved_at = 0
+        self._file_mtime = None
+
+    def _set_rows(self, recipe_ids, versions, sizes, posting_ingredients,
+                  posting_rows, synced_at):
+        self.recipe_ids = recipe_ids
+        self.versions = versions
+        self.sizes = sizes
+        self.alive = np.ones(len(recipe_ids), dtype=bool)
+        self.posting_ingredients = posting_ingredients
+        self.posting_rows = posting_rows
+        self.tail_ingredients = np.zeros(0, dtype=np.int64)
+        self.tail_rows = np.zeros(0, dtype=np.int64)
+        self.synced_at = synced_at
+
+    def _build(self):
+        synced_at = timezone.now().timestamp()
+        empty = np.zeros(0, dtype=np.int64)
+        self._set_rows(empty, np.zeros(0, dtype=np.float64), empty, empty,
+                       empty, synced_at)
+        self._append(*read_ingredients())
+        self._compact()
+
+    def build(self):
+        """Строит индекс по всем рецептам и сохраняет его в файл."""
+        with self._lock:
+            self._build()
+            self._save()
+            self._loaded = True
+            self._refreshed_at = time.monotonic()
+        return len(self.recipe_ids)
+
+    def _load(self):
+        path = settings.PANTRY_INDEX_PATH
+        try:
+            data = np.load(path)
+            mtime = os.stat(path).st_mtime
+        except (OSError, ValueError):
+            return False
+        with data:
+            if int(data['format_version']) != FORMAT_VERSION:
+                return False
+            self._set_rows(
+                data['recipe_ids'], data['versions'], data['sizes'],
+                data['posting_ingredients'], data['posting_rows'],
+                float(data['synced_at']))
+        self._file_mtime = mtime
+        self._saved_at = time.monotonic()
+        return True
+
+    def _save(self):
+        path = settings.PANTRY_INDEX_PATH
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._compact()
+        temporary = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(temporary, format_version=np.int64(FORMAT_VERSION),
+                 recipe_ids=self.recipe_ids, versions=self.versions,
+                 sizes=self.sizes,
+                 posting_ingredients=self.posting_ingredients,
+                 posting_rows=self.posting_rows,
+                 synced_at=np.float64(self.synced_at))
+        os.replace(temporary, path)
+        self._file_mtime = os.stat(path).st_mtime
+        self._saved_at = time.monotonic()
+
+    def _file_changed(self):
+        try:
+            return os.stat(settings.PANTRY_INDEX_PATH).st_mtime != (
+                self._file_mtime)
+        except OSError:
+            return False
+
+    def _append(self, recipe_ids, ingredient_ids, versions):
+        """Дописывает рецепты со связями из столбцов read_ingredients
+        в хвост индекса.
+        """
+        unique_ids, first, rows = np.unique(
+            recipe_ids, return_index=True, return_inverse=True)
+        rows = rows.reshape(-1)
+        self.tail_ingredients = np.concatenate(
+            (self.tail_ingredients, ingredient_ids))
+        self.tail_rows = np.concatenate(
+            (self.tail_rows, rows + len(self.recipe_ids)))
+        self.recipe_ids = np.concatenate((self.recipe_ids, unique_ids))
+        self.versions = np.concatenate((self.versions, versions[first]))
+        self.sizes = np.concatenate(
+            (self.sizes, np.bincount(rows, minlength=len(unique_ids))))
+        self.alive = np.concatenate(
+            (self.alive, np.ones(len(unique_ids), dtype=bool)))
+
+    def _compact(self):
+        """Удаляет устаревшие строки и сливает хвост с основной частью."""
+        ingredients = np.concatenate(
+            (self.posting_ingredients, self.tail_ingredients))
+        rows = np.concatenate((self.posting_rows, self.tail_rows))
+        keep = self.alive[rows]
+        new_rows = np.cumsum(self.alive) - 1
+        ingredients, rows = ingredients[keep], new_rows[rows[keep]]
+        order = np.lexsort((rows, ingredients))
+        self.posting_ingredients = ingredients[order]
+        self.posting_rows = rows[order]
+        self.tail_ingredients = np.zeros(0, dtype=np.int64)
+        self.tail_rows = np.zeros(0, dtype=np.int64)
+        alive = self.alive
+        self.recipe_ids = self.recipe_ids[alive]
+        self.versions = self.versions[alive]
+        self.sizes = self.sizes[alive]
+        self.alive = self.alive[alive]
+
+    def _apply_changes(self):
+        """Перечитывает ингредиенты рецептов, изменённых после
+        последней синхронизации.
+        """
+        synced_at = timezone.now().timestamp()
+        since = datetime.fromtimestamp(self.synced_at - SYNC_OVERLAP,
+                                       tz=timezone.utc)
+        changed = dict(Recipe.objects.filter(
+            updated_at__gte=since).values_list('id', 'updated_at'))
+        rows = np.flatnonzero(
+            np.isin(self.recipe_ids, list(changed)) & self.alive)
+        for row in rows:
+            recipe_id = int(self.recipe_ids[row])
+            if self.versions[row] == changed[recipe_id].timestamp():
+                del changed[recipe_id]
+            else:
+                self.alive[row] = False
+        if changed:
+            self._append(*read_ingredients(list(changed)))
+        self.synced_at = synced_at
+        return len(changed)
+
+    def refresh(self):
+        """Загружает индекс при первом обращении или после пересборки
+        и не чаще раза в PANTRY_INDEX_REFRESH_INTERVAL секунд
+        подтягивает изменённые рецепты.
+
+        Индекс целиком строится только командой rebuild_pantry_index:
+        пока файла нет, индекс считается пустым.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._loaded and (now - self._refreshed_at
+                                 < settings.PANTRY_INDEX_REFRESH_INTERVAL):
+                return
+            if (not self._loaded or self._file_changed()) and (
+                    not self._load() and not self._loaded):
+                logger.warning(
+                    'Индекс продуктов %s не найден, выполните '
+                    'rebuild_pantry_index', settings.PANTRY_INDEX_PATH)
+                return
+            self._loaded = True
+            changed = self._apply_changes()
+            if len(self.tail_rows) > max(10000, len(self.posting_rows) // 10):
+                self._compact()
+            if changed and (now - self._saved_at
+                            > settings.PANTRY_INDEX_SAVE_INTERVAL):
+                self._save()
+            self._refreshed_at = now
+
+    def remove(self, recipe_ids):
+        """Помечает устаревшими строки удалённых рецептов."""
+        with self._lock:
+            if self._loaded:
+                self.alive[np.isin(self.recipe_ids, recipe_ids)] = False
+
+    def get_matched(self, ingredient_ids):
+        """Число ингредиентов из ingredient_ids в каждой строке."""
+        start = np.searchsorted(self.posting_ingredients, ingredient_ids,
+                                side='left')
+        end = np.searchsorted(self.posting_ingredients, ingredient_ids,
+                              side='right')
+        rows = [self.posting_rows[first:last]
+                for first, last in zip(start, end)]
+        rows.append(self.tail_rows[
+            np.isin(self.tail_ingredients, ingredient_ids)])
+        return np.bincount(np.concatenate(rows),
+                           minlength=len(self.recipe_ids))
+
+    def search(self, ingredient_ids, max_missing, limit):
+        """Не больше limit рецептов, из ингредиентов которых
+        в ingredient_ids нет не более max_missing, вида
+        [(recipe_id, missing, coverage)].
+
+        Рецепты упорядочены по убыванию доли имеющихся ингредиентов,
+        затем по числу недостающих и от новых к старым.
+        """
+        self.refresh()
+        ingredient_ids = np.unique(np.asarray(ingredient_ids,
+                                              dtype=np.int64))
+        with self._lock:
+            if not self._loaded:
+                return []
+            matched = self.get_matched(ingredient_ids)
+            missing = self.sizes - matched
+            rows = np.flatnonzero(
+                (matched > 0) & (missing <= max_missing) & self.alive)
+            coverage = matched[rows] / self.sizes[rows]
+            order = np.lexsort(
+                (-self.recipe_ids[rows], missing[rows], -coverage))[:limit]
+            return [
+                (int(recipe_id), int(recipe_missing), float(value))
+                for recipe_id, recipe_missing, value in zip(
+                    self.recipe_ids[rows[order]], missing[rows[order]],
+                    coverage[order])
+            ]
+
+
+pantry_index = PantryIndex()
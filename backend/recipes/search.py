@@ -0,0 +1,113 @@
+"""Полнотекстовый поиск рецептов по названию, ингредиентам и описанию.
+
+В PostgreSQL документ хранится в столбце search_vector (tsvector
+с конфигурацией russian) под GIN-индексом, в SQLite — в виртуальной
+таблице FTS5 recipes_recipe_fts. Обе структуры создаются миграцией
+0004_recipe_search_index и обновляются update_search_index().
+"""
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+
+WORD_RE = re.compile(r'\w+')
+
+POSTGRES_UPDATE_SQL = """
+UPDATE recipes_recipe r SET search_vector =
+    setweight(to_tsvector('russian', translate(r.name, 'ёЁ', 'еЕ')), 'A')
+    || setweight(to_tsvector('russian', translate(coalesce((
+        SELECT string_agg(i.name, ' ')
+        FROM recipes_recipeingredient ri
+        JOIN recipes_ingredient i ON i.id = ri.ingredient_id
+        WHERE ri.recipe_id = r.id), ''), 'ёЁ', 'еЕ')), 'B')
+    || setweight(to_tsvector('russian', translate(r.text, 'ёЁ', 'еЕ')), 'C')
+"""
+
+SQLITE_DELETE_SQL = 'DELETE FROM recipes_recipe_fts'
+
+SQLITE_INSERT_SQL = """
+INSERT INTO recipes_recipe_fts (rowid, name, ingredients, text)
+SELECT r.id,
+       replace(replace(r.name, 'ё', 'е'), 'Ё', 'Е'),
+       replace(replace(coalesce((
+           SELECT group_concat(i.name, ' ')
+           FROM recipes_recipeingredient ri
+           JOIN recipes_ingredient i ON i.id = ri.ingredient_id
+           WHERE ri.recipe_id = r.id), ''), 'ё', 'е'), 'Ё', 'Е'),
+       replace(replace(r.text, 'ё', 'е'), 'Ё', 'Е')
+FROM recipes_recipe r
+"""
+
+
+def _id_filter(column, recipe_ids):
+    placeholders = ', '.join(['%s'] * len(recipe_ids))
+    return f' WHERE {column} IN ({placeholders})', list(recipe_ids)
+
+
+def update_search_index(recipe_ids=None):
+    """Пересчитывает поисковые документы рецептов recipe_ids
+    или всех рецептов, если recipe_ids не передан.
+
+    Документы удалённых рецептов из recipe_ids удаляются из FTS5.
+    """
+    if recipe_ids is not None and not recipe_ids:
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            where, params = ('', []) if recipe_ids is None else _id_filter(
+                'r.id', recipe_ids)
+            cursor.execute(POSTGRES_UPDATE_SQL + where, params)
+        elif connection.vendor == 'sqlite':
+            if recipe_ids is None:
+                cursor.execute(SQLITE_DELETE_SQL)
+                cursor.execute(SQLITE_INSERT_SQL)
+                return
+            where, params = _id_filter('rowid', recipe_ids)
+            cursor.execute(SQLITE_DELETE_SQL + where, params)
+            where, params = _id_filter('r.id', recipe_ids)
+            cursor.execute(SQLITE_INSERT_SQL + where, params)
+
+
+def get_search_terms(query):
+    return WORD_RE.findall(query.replace('ё', 'е').replace('Ё', 'Е'))
+
+
+def search_recipes(queryset, query):
+    """Рецепты из queryset, подходящие под query, в порядке релевантности.
+
+    Каждое слово запроса ищется как префикс, все слова обязательны.
+    """
+    terms = get_search_terms(query)
+    if not terms:
+        return queryset.none()
+    if connection.vendor == 'postgresql':
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        queryset = queryset.filter(RawSQL(
+            "recipes_recipe.search_vector @@ to_tsquery('russian', %s)",
+            (tsquery,), output_field=BooleanField())).annotate(
+                search_rank=RawSQL(
+                    "ts_rank(recipes_recipe.search_vector, "
+                    "to_tsquery('russian', %s))",
+                    (tsquery,), output_field=FloatField()))
+    elif connection.vendor == 'sqlite':
+        match = ' '.join(
+            '"{}"*'.format(term.replace('"', '""')) for term in terms)
+        queryset = queryset.filter(RawSQL(
+            'recipes_recipe.id IN (SELECT rowid FROM recipes_recipe_fts '
+            'WHERE recipes_recipe_fts MATCH %s)',
+            (match,), output_field=BooleanField())).annotate(
+                search_rank=RawSQL(
+                    '(SELECT -bm25(recipes_recipe_fts, 10.0, 5.0, 1.0) '
+                    'FROM recipes_recipe_fts '
+                    'WHERE recipes_recipe_fts MATCH %s '
+                    'AND rowid = recipes_recipe.id)',
+                    (match,), output_field=FloatField()))
+    else:
+        condition = Q()
+        for term in terms:
+            condition &= (Q(name__icontains=term)
+                          | Q(text__icontains=term)
+                          | Q(ingredients__name__icontains=term))
+        return queryset.filter(condition).distinct()
+    return queryset.order_by('-search_rank', '-pub_date')
@@ -0,0 +1,302 @@
+"""Индекс похожих рецептов по наборам ингредиентов: MinHash и LSH.
+
+Для каждого рецепта считается MinHash-подпись множества id его
+ингредиентов, подпись режется на SIMILAR_RECIPES_BANDS полос по
+SIMILAR_RECIPES_ROWS значений, и каждая полоса сворачивается в 32-битный
+ключ. Рецепты с совпадающим ключом хотя бы в одной полосе становятся
+кандидатами, кандидаты ранжируются по точному коэффициенту Жаккара.
+
+Индекс хранится в массивах NumPy в памяти процесса и в файле
+SIMILAR_RECIPES_INDEX_PATH. Изменённые рецепты находятся по updated_at
+и дописываются в конец массивов; отсортированные по ключам полосы
+пересобираются, когда таких строк накапливается много.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Recipe, RecipeIngredient
+from .utils import SYNC_OVERLAP
+
+PRIME = (1 << 31) - 1
+HASH_SEED = 20221116
+FORMAT_VERSION = 1
+BUILD_CHUNK_SIZE = 5000
+
+logger = logging.getLogger(__name__)
+
+
+def get_hash_params(permutations):
+    random_state = np.random.RandomState(HASH_SEED)
+    a = random_state.randint(1, PRIME, size=permutations).astype(np.uint64)
+    b = random_state.randint(0, PRIME, size=permutations).astype(np.uint64)
+    return a, b
+
+
+def get_band_keys(offsets, ingredient_ids):
+    """Ключи LSH-полос для рецептов, ингредиенты которых лежат в
+    ingredient_ids[offsets[i]:offsets[i + 1]]; возвращает массив
+    (число рецептов, SIMILAR_RECIPES_BANDS) типа uint32.
+    """
+    bands = settings.SIMILAR_RECIPES_BANDS
+    rows = settings.SIMILAR_RECIPES_ROWS
+    a, b = get_hash_params(bands * rows)
+    values = np.asarray(ingredient_ids, dtype=np.uint64)
+    hashes = (np.outer(values, a) + b) % PRIME
+    signatures = np.minimum.reduceat(hashes, offsets[:-1], axis=0)
+    signatures = signatures.reshape(len(signatures), bands, rows)
+    keys = np.zeros(signatures.shape[:2], dtype=np.uint64)
+    for row in range(rows):
+        keys = keys * np.uint64(1000003) ^ signatures[:, :, row]
+    return (keys ^ (keys >> np.uint64(32))).astype(np.uint32)
+
+
+def load_ingredient_sets(recipe_ids=None):
+    """Наборы ингредиентов рецептов вида {recipe_id: set}."""
+    rows = RecipeIngredient.objects.order_by()
+    if recipe_ids is not None:
+        rows = rows.filter(recipe_id__in=recipe_ids)
+    sets = {}
+    for recipe_id, ingredient_id in rows.values_list(
+            'recipe_id', 'ingredient_id').iterator():
+        sets.setdefault(recipe_id, set()).add(ingredient_id)
+    return sets
+
+
+def iter_signature_chunks(recipes):
+    """Ключи полос для рецептов из итератора (recipe_id, version,
+    ingredient_id), упорядоченного по recipe_id, порциями
+    (recipe_ids, versions, keys).
+    """
+    def flush():
+        offsets = np.cumsum([0] + lengths)
+        return (np.array(recipe_ids, dtype=np.int64),
+                np.array(versions, dtype=np.float64),
+                get_band_keys(offsets, ingredient_ids))
+
+    recipe_ids, versions, lengths, ingredient_ids = [], [], [], []
+    for recipe_id, version, ingredient_id in recipes:
+        if not recipe_ids or recipe_ids[-1] != recipe_id:
+            if len(recipe_ids) >= BUILD_CHUNK_SIZE:
+                yield flush()
+                recipe_ids, versions, lengths, ingredient_ids = (
+                    [], [], [], [])
+            recipe_ids.append(recipe_id)
+            versions.append(version.timestamp())
+            lengths.append(0)
+        lengths[-1] += 1
+        ingredient_ids.append(ingredient_id)
+    if recipe_ids:
+        yield flush()
+
+
+def read_signatures(recipe_ids=None):
+    rows = RecipeIngredient.objects.order_by('recipe_id')
+    if recipe_ids is not None:
+        rows = rows.filter(recipe_id__in=recipe_ids)
+    chunks = list(iter_signature_chunks(rows.values_list(
+        'recipe_id', 'recipe__updated_at', 'ingredient_id').iterator()))
+    if not chunks:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64),
+                np.zeros((0, settings.SIMILAR_RECIPES_BANDS),
+                         dtype=np.uint32))
+    return tuple(np.concatenate(parts) for parts in zip(*chunks))
+
+
+def jaccard(first, second):
+    union = len(first | second)
+    return len(first & second) / union if union else 0.0
+
+
+class SimilarRecipesIndex:
+    """Индекс похожих рецептов в памяти процесса.
+
+    Строки массивов recipe_ids, versions, alive и keys соответствуют
+    версиям рецептов; первые sorted_count строк дополнительно разложены
+    по полосам в sorted_keys/sorted_rows для бинарного поиска, остальные
+    просматриваются линейно.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._refreshed_at = 0
+        self._saved_at = 0
+        self._file_mtime = None
+
+    def get_params(self):
+        return np.array([FORMAT_VERSION, settings.SIMILAR_RECIPES_BANDS,
+                         settings.SIMILAR_RECIPES_ROWS, HASH_SEED])
+
+    def _set_rows(self, recipe_ids, versions, keys, synced_at):
+        self.recipe_ids = recipe_ids
+        self.versions = versions
+        self.keys = keys
+        self.alive = np.ones(len(recipe_ids), dtype=bool)
+        self.synced_at = synced_at
+        self._compact()
+
+    def _compact(self):
+        """Удаляет устаревшие строки и сортирует ключи каждой полосы."""
+        alive = self.alive
+        self.recipe_ids = self.recipe_ids[alive]
+        self.versions = self.versions[alive]
+        self.keys = self.keys[alive]
+        self.alive = self.alive[alive]
+        self.sorted_rows = np.argsort(self.keys, axis=0, kind='stable').T
+        self.sorted_keys = np.take_along_axis(
+            self.keys, self.sorted_rows.T, axis=0).T
+        self.sorted_count = len(self.recipe_ids)
+
+    def build(self):
+        """Строит индекс по всем рецептам и сохраняет его в файл."""
+        with self._lock:
+            synced_at = timezone.now().timestamp()
+            self._set_rows(*read_signatures(), synced_at)
+            self._save()
+            self._loaded = True
+            self._refreshed_at = time.monotonic()
+        return len(self.recipe_ids)
+
+    def _load(self):
+        path = settings.SIMILAR_RECIPES_INDEX_PATH
+        try:
+            data = np.load(path)
+            mtime = os.stat(path).st_mtime
+        except (OSError, ValueError):
+            return False
+        with data:
+            if not np.array_equal(data['params'], self.get_params()):
+                return False
+            self._set_rows(data['recipe_ids'], data['versions'],
+                           data['keys'], float(data['synced_at']))
+        self._file_mtime = mtime
+        self._saved_at = time.monotonic()
+        return True
+
+    def _save(self):
+        path = settings.SIMILAR_RECIPES_INDEX_PATH
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        alive = self.alive
+        temporary = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(temporary, params=self.get_params(),
+                 recipe_ids=self.recipe_ids[alive],
+                 versions=self.versions[alive], keys=self.keys[alive],
+                 synced_at=np.float64(self.synced_at))
+        os.replace(temporary, path)
+        self._file_mtime = os.stat(path).st_mtime
+        self._saved_at = time.monotonic()
+
+    def _file_changed(self):
+        try:
+            return os.stat(
+                settings.SIMILAR_RECIPES_INDEX_PATH).st_mtime != (
+                    self._file_mtime)
+        except OSError:
+            return False
+
+    def _apply_changes(self):
+        """Дописывает новые версии рецептов, изменённых после
+        последней синхронизации.
+        """
+        synced_at = timezone.now().timestamp()
+        since = datetime.fromtimestamp(self.synced_at - SYNC_OVERLAP,
+                                       tz=timezone.utc)
+        changed = dict(Recipe.objects.filter(
+            updated_at__gte=since).values_list('id', 'updated_at'))
+        rows = np.flatnonzero(np.isin(self.recipe_ids, list(changed)))
+        for row in rows[self.alive[rows]]:
+            version = changed[int(self.recipe_ids[row])].timestamp()
+            if self.versions[row] == version:
+                del changed[int(self.recipe_ids[row])]
+            else:
+                self.alive[row] = False
+        if changed:
+            recipe_ids, versions, keys = read_signatures(list(changed))
+            self.recipe_ids = np.concatenate((self.recipe_ids, recipe_ids))
+            self.versions = np.concatenate((self.versions, versions))
+            self.keys = np.concatenate((self.keys, keys))
+            self.alive = np.concatenate(
+                (self.alive, np.ones(len(recipe_ids), dtype=bool)))
+        self.synced_at = synced_at
+        return len(changed)
+
+    def refresh(self):
+        """Загружает индекс из файла при первом обращении или после
+        пересборки и не чаще раза в SIMILAR_RECIPES_REFRESH_INTERVAL
+        секунд подтягивает изменения.
+
+        Индекс целиком строится только командой rebuild_similar_index:
+        пока файла нет, индекс считается пустым.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._loaded and (now - self._refreshed_at
+                                 < settings.SIMILAR_RECIPES_REFRESH_INTERVAL):
+                return
+            if (not self._loaded or self._file_changed()) and (
+                    not self._load() and not self._loaded):
+                logger.warning(
+                    'Индекс похожих рецептов %s не найден, выполните '
+                    'rebuild_similar_index',
+                    settings.SIMILAR_RECIPES_INDEX_PATH)
+                return
+            self._loaded = True
+            changed = self._apply_changes()
+            unsorted = len(self.recipe_ids) - self.sorted_count
+            if unsorted > max(1000, self.sorted_count // 10):
+                self._compact()
+            if changed and (now - self._saved_at
+                            > settings.SIMILAR_RECIPES_SAVE_INTERVAL):
+                self._save()
+            self._refreshed_at = now
+
+    def get_candidates(self, keys, exclude):
+        """Строки, совпадающие с keys хотя бы в одной полосе,
+        по убыванию числа совпавших полос.
+        """
+        matches = [np.flatnonzero(
+            (self.keys[self.sorted_count:] == keys).any(axis=1)
+        ) + self.sorted_count]
+        for band, key in enumerate(keys):
+            band_keys = self.sorted_keys[band]
+            start = np.searchsorted(band_keys, key, side='left')
+            end = np.searchsorted(band_keys, key, side='right')
+            matches.append(self.sorted_rows[band][start:end])
+        rows, hits = np.unique(np.concatenate(matches), return_counts=True)
+        alive = self.alive[rows] & (self.recipe_ids[rows] != exclude)
+        rows, hits = rows[alive], hits[alive]
+        best = np.argsort(-hits, kind='stable')
+        best = best[:settings.SIMILAR_RECIPES_CANDIDATES]
+        return [int(recipe_id) for recipe_id in self.recipe_ids[rows[best]]]
+
+    def similar(self, recipe_id, limit):
+        """Не больше limit рецептов, похожих на recipe_id, вида
+        [(recipe_id, similarity)] по убыванию коэффициента Жаккара.
+        """
+        ingredients = load_ingredient_sets([recipe_id]).get(recipe_id)
+        if not ingredients:
+            return []
+        self.refresh()
+        ingredient_ids = sorted(ingredients)
+        keys = get_band_keys(np.array([0, len(ingredient_ids)]),
+                             ingredient_ids)[0]
+        with self._lock:
+            if not self._loaded:
+                return []
+            candidates = self.get_candidates(keys, recipe_id)
+        sets = load_ingredient_sets(candidates)
+        scored = sorted(
+            ((pk, jaccard(ingredients, sets[pk]))
+             for pk in candidates if pk in sets),
+            key=lambda item: (-item[1], -item[0]))
+        return [(pk, score) for pk, score in scored[:limit] if score > 0]
+
+
+similar_recipes_index = SimilarRecipesIndex()
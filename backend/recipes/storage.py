@@ -0,0 +1,47 @@
+"""Хранилище картинок рецептов с адресацией по содержимому."""
+import hashlib
+import os
+import posixpath
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Файловое хранилище, именующее файлы по SHA-256 содержимого.
+
+    Файл abcdef….png из каталога upload_to сохраняется как
+    <upload_to>/ab/cd/abcdef….png. Повторная загрузка того же
+    содержимого не записывает файл заново, а обновляет время его
+    изменения, чтобы collect_recipe_images --min-age не удалил файл,
+    на который только что сослались снова.
+    """
+
+    def get_content_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        hexdigest = digest.hexdigest()
+        extension = os.path.splitext(name)[1].lower()
+        return posixpath.join(posixpath.dirname(name), hexdigest[:2],
+                              hexdigest[2:4], hexdigest + extension)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.get_content_name(name, content)
+        if self.exists(name):
+            try:
+                os.utime(self.path(name))
+                return name
+            except FileNotFoundError:
+                pass
+        return self._save(name, content)
+
+
+recipe_image_storage = ContentAddressedStorage()
@@ -0,0 +1,48 @@
+"""Пул фоновых потоков для задач вне цикла запроса."""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def create_executor():
+    return ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS,
+                              thread_name_prefix='foodgram-background')
+
+
+def get_executor():
+    """Общий пул потоков, создаётся при первой задаче."""
+    with _executor_lock:
+        return create_executor()
+
+
+def run_task(func, *args):
+    try:
+        close_old_connections()
+        func(*args)
+    except Exception:
+        logger.exception(f'Ошибка фоновой задачи {func.__name__}')
+    finally:
+        connection.close()
+
+
+def run_in_background(func, *args):
+    """Выполняет func(*args) в пуле потоков после фиксации транзакции.
+
+    При BACKGROUND_WORKERS = 0 задача выполняется синхронно.
+    """
+    def submit():
+        if not settings.BACKGROUND_WORKERS:
+            func(*args)
+            return
+        get_executor().submit(run_task, func, *args)
+
+    transaction.on_commit(submit)
@@ -0,0 +1,16 @@
+"""Общие вспомогательные функции и константы приложения recipes."""
+from itertools import islice
+
+# Повторно просматриваемый интервал updated_at на случай транзакций,
+# зафиксированных позже отметки синхронизации индексов
+SYNC_OVERLAP = 60
+
+
+def iter_chunks(iterable, size):
+    """Разбивает iterable на списки не длиннее size."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -1,9 +1,30 @@
 from django.contrib import admin
+from django.db import transaction
 
+from api.pagination import CachedCountPaginator  # isort: split
+from recipes.counters import subtract_users  # isort: split
+from recipes.models import Cart, ShoppingListItem  # isort: split
 from .models import User
 
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
     list_display = ('pk', 'email', 'username', 'first_name', 'last_name')
-    list_filter = ('email', 'first_name')
+    search_fields = ('username', 'email')
+    show_full_result_count = False
+    paginator = CachedCountPaginator
+
+    @transaction.atomic
+    def delete_model(self, request, obj):
+        ShoppingListItem.objects.remove_carts(
+            Cart.objects.filter(recipe__author=obj).exclude(user=obj))
+        subtract_users([obj.pk])
+        super().delete_model(request, obj)
+
+    @transaction.atomic
+    def delete_queryset(self, request, queryset):
+        ShoppingListItem.objects.remove_carts(
+            Cart.objects.filter(recipe__author__in=queryset).exclude(
+                user__in=queryset))
+        subtract_users(queryset)
+        super().delete_queryset(request, queryset)
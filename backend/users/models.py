@@ -25,6 +25,20 @@ class User(AbstractUser):
         verbose_name=_('password'),
         max_length=150,
     )
+    recipes_count = models.IntegerField(
+        verbose_name=_('recipes count'),
+        default=0,
+        editable=False,
+    )
+    followers_count = models.IntegerField(
+        verbose_name=_('followers count'),
+        default=0,
+        editable=False,
+    )
+    updated_at = models.DateTimeField(
+        verbose_name=_('date of update'),
+        auto_now=True,
+    )
 
     class Meta:
         verbose_name = _('user')